@@ -1,43 +1,77 @@
 import collections
 import glob
 import logging
+import math
 import time
 import operator
 import warnings
-from os import listdir, makedirs
-from os.path import basename, join, isdir, splitext, dirname
-from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os import makedirs, replace
+from os.path import basename, join, isdir, splitext, dirname, exists, getsize
+from collections import OrderedDict, deque
 import random
 import json
 
 import cooler
 import cooltools
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection, PolyCollection
 import mpl_toolkits.axisartist as AA
 import numpy as np
 import pandas as pd
 import requests
 import scipy
+import scipy.sparse
+from scipy.cluster.hierarchy import linkage, fcluster
 import seaborn as sns
 from mpl_toolkits.axes_grid1 import host_subplot
 from mpl_toolkits.mplot3d import Axes3D
 from sklearn.cluster import KMeans, AgglomerativeClustering, SpectralClustering, AffinityPropagation, MeanShift
 from sklearn.decomposition import PCA
+from sklearn.metrics.pairwise import rbf_kernel
 from sklearn.manifold import TSNE
-from sklearn.metrics import silhouette_score, silhouette_samples
-from utils import whether_to_expand, get_noisy_stripes, adjust_boundaries, find_global_optima, adjust_global_optima, \
-    get_d_score, produce_boundaries_segmentation, calc_mean_tad_size, whether_tad_noisy
+try:
+    from openTSNE import TSNE as OpenTSNE
+except ImportError:
+    OpenTSNE = None
+from joblib import Parallel, delayed
+from utils import check_mtx, whether_to_expand, get_noisy_stripes, adjust_boundaries, find_global_optima, adjust_global_optima, \
+    get_d_score_batch, produce_boundaries_segmentation, calc_mean_tad_size, whether_tad_noisy_batch, \
+    get_silhouette_samples, get_silhouette_samples_batch, get_simplified_silhouette_samples
 
 sns.set(context='paper', style='whitegrid')
 warnings.filterwarnings("ignore")
 
 
-def download_files(input_type, input_path):
+def _download_file(session, url, filename):
+    """
+    Function to download single file by url with streaming write to disk. The file is written under temporary name
+    and renamed in the end, so interrupted downloads are not taken for complete ones.
+    :param session: requests session to reuse connections between downloads.
+    :param url: access url of the file.
+    :param filename: path to the file to be written.
+    :return: path to the downloaded file.
+    """
+    with session.get(url, allow_redirects=True, stream=True) as r:
+        r.raise_for_status()
+        with open(filename + '.part', 'wb') as f:
+            for chunk in r.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+    replace(filename + '.part', filename)
+    return filename
+
+
+def download_files(input_type, input_path, max_workers=8):
     """
     Function to download E-MTAB file and/or Coolfiles.
     :param input_type: type of input (url, coolfiles or e-mtab).
     :param input_path: path to the input (url, path to the directory with coolfiles, path to the e-mtab file).
+    :param max_workers: number of coolfiles to be downloaded simultaneously.
     :return: path to the directory with coolfiles.
     """
     if input_type == 'coolfiles':
@@ -45,10 +79,10 @@ def download_files(input_type, input_path):
         return input_path
     elif input_type == 'e-mtab' or input_type == 'url':
         if input_type == 'url':
-            r = requests.get(input_path, allow_redirects=True)
             if not isdir('../data/e-mtabs'): makedirs('../data/e-mtabs')
             e_mtab_path = join('../data/e-mtabs', basename(input_path))
-            open(e_mtab_path, 'wb').write(r.content)
+            with requests.Session() as session:
+                _download_file(session, input_path, e_mtab_path)
             logging.info("DOWNLOAD_FILES| E-MTAB file {} has been downloaded in directory {} by access url {}".format(
                 basename(input_path), dirname(e_mtab_path), input_path))
         else:
@@ -56,26 +90,31 @@ def download_files(input_type, input_path):
                                                                                             dirname(input_path)))
             e_mtab_path = input_path
         logging.info("DOWNLOAD_FILES| Reading E-MTAB file {}".format(e_mtab_path))
-        data = pd.read_csv(e_mtab_path, sep='\t')
+        data = pd.read_csv(e_mtab_path, sep='\t', dtype=str,
+                           usecols=['Comment[experiment]', 'Derived Array Data File',
+                                    'Comment [Derived ArrayExpress FTP file]'])
         cool_files = list(set(data[data['Comment[experiment]'] == 'Hi-C']['Derived Array Data File']))
         baseurl = "https://www.ebi.ac.uk/arrayexpress/files/"
-        urls = [(baseurl +
-                 data[data['Derived Array Data File'] == x].iloc[0]['Comment [Derived ArrayExpress FTP file]'].split('/')[-2] + '/' +
-                 data[data['Derived Array Data File'] == x].iloc[0]['Comment [Derived ArrayExpress FTP file]'].split('/')[-1] + '/' + x)
-                for x in cool_files]
+        # last two parts of ftp path for each file (taken from the first row that mentions it)
+        ftp_dirs = data.drop_duplicates('Derived Array Data File').set_index('Derived Array Data File')[
+            'Comment [Derived ArrayExpress FTP file]'].str.split('/').str[-2:].str.join('/')
+        urls = [baseurl + ftp_dirs[x] + '/' + x for x in cool_files]
         coolfiles_path = join('../data/coolfiles', splitext(basename(input_path))[0])
         logging.info("DOWNLOAD_FILES| All coolfiles will be downloaded in directory {}".format(coolfiles_path))
         if not isdir(coolfiles_path):
             logging.info("DOWNLOAD_FILES| Make directory {}".format(coolfiles_path))
             makedirs(coolfiles_path)
-        if len(listdir(coolfiles_path)) == 0:
-            logging.info("DOWNLOAD_FILES| Directory {} is empty. Let's download our coolfiles!".format(coolfiles_path))
+        to_download = [(url, join(coolfiles_path, file)) for url, file in zip(urls, cool_files)
+                       if not (exists(join(coolfiles_path, file)) and getsize(join(coolfiles_path, file)) > 0)]
+        if len(to_download) > 0:
+            logging.info("DOWNLOAD_FILES| {} coolfiles are missing in directory {}. Let's download them!".format(
+                len(to_download), coolfiles_path))
             logging.info("DOWNLOAD_FILES| Start downloading coolfiles...")
             in_time = time.time()
-            for url, file in zip(urls, cool_files):
-                filename = join(coolfiles_path, file)
-                r = requests.get(url, allow_redirects=True)
-                open(filename, 'wb').write(r.content)
+            with requests.Session() as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(_download_file, session, url, filename) for url, filename in to_download]
+                for future in as_completed(futures):
+                    logging.info("DOWNLOAD_FILES| Coolfile {} has been downloaded".format(future.result()))
             time_elapsed = time.time() - in_time
             logging.info("DOWNLOAD_FILES| Downloading completed in {:.0f}m {:.0f}s".format(time_elapsed // 60,
                                                                                            time_elapsed % 60))
@@ -84,13 +123,19 @@ def download_files(input_type, input_path):
         raise Exception('You typed incorrect input_type parameter!')
 
 
-def load_cool_files(coolfiles_path, chromnames, resolution, stage_names=None):
+def load_cool_files(coolfiles_path, chromnames, resolution, stage_names=None, sparse=False, dtype=np.float32):
     """
     Function to load coolfiles.
     :param coolfiles_path: path to the directory with coolfiles.
     :param chromnames: list of chromosomes names.
     :param stage_names: name(s) of developmental stage to investigate. In case of clustering we recommend to pass None
     to load all stages you have.
+    :param sparse: True to store contact matrices as scipy.sparse CSR matrices (memory scales with the number of
+    non-zero pixels instead of squared chromosome size), False to store dense numpy matrices. Only viz_tads and
+    D-scores work with sparse matrices without densifying; get_noisy_stripes still densifies one chromosome at a time
+    into float64 matrix for segmentation.
+    :param dtype: data type of stored contact matrices. float32 halves memory of loaded datasets, pass np.float64 to
+    keep the precision cooler returns.
     :return: python dictionary with keys of stages and chromnames, and values of contact matrices, and dictionary with
     keys of stages and values of cooler files.
     """
@@ -106,24 +151,202 @@ def load_cool_files(coolfiles_path, chromnames, resolution, stage_names=None):
     balance = True
     logging.info("LOAD_COOL_FILES| Start loading chromosomes and stages...")
     in_time = time.time()
-    for label, file in list(zip(labels, files)):
+    for label, file in zip(labels, files):
         try:
             c = cooler.Cooler(file + '::/resolutions/{}'.format(resolution))
         except Exception as e:
             c = cooler.Cooler(file)
         cool_sets[label] = c
+        selector = c.matrix(balance=balance, sparse=sparse)
         for ch in chromnames:
-            mtx = c.matrix(balance=balance).fetch(ch)
-            datasets[label][ch] = mtx.copy()
+            mtx = selector.fetch(ch).tocsr() if sparse else selector.fetch(ch)
+            datasets[label][ch] = mtx.astype(dtype, copy=False)
     time_elapsed = time.time() - in_time
     logging.info("LOAD_COOL_FILES| Loading completed in {:.0f}m {:.0f}s".format(time_elapsed // 60, time_elapsed % 60))
 
     return datasets, cool_sets
 
 
+def _search_opt_window_chrom(ch, datasets, clr, grid, mis, mts, method, resolution, expected, exp, percentile, eps,
+                             window_eps, k, bs_grid):
+    """
+    Function to search optimal window for a single chromosome. It is a worker of search_opt_window function.
+    :param ch: chromosome of interest.
+    :param datasets: python dictionary with loaded chromosomes and stages (at least stage exp for chromosome ch).
+    :param clr: cooler file that corresponds to stage exp.
+    :param bs_grid: list of boundary strength thresholds to be checked.
+    Other parameters are the same as in search_opt_window function.
+    :return: dataframe with segmentation for all window values for the best boundary strength threshold, dictionary
+    with stats for each window value and optimal window value.
+    """
+    logging.info("SEARCH_OPT_WINDOW| Start chromosome {}".format(ch))
+
+    filters, mtx, good_bins = get_noisy_stripes(datasets, ch, method, resolution, exp, percentile=percentile)
+
+    all_bins_cnt = good_bins.shape[0]
+    good_bins_cnt = good_bins[good_bins == True].shape[0]
+    expected_bins = expected / resolution
+    tads_expected_cnt = good_bins_cnt // expected_bins
+
+    logging.info("SEARCH_OPT_WINDOW| For chrm {} of shape {} bins we have {} good bins and {} expected count of "
+                 "TADs (according to expected TAD size)".format(ch, all_bins_cnt, good_bins_cnt, tads_expected_cnt))
+    logging.info("SEARCH_OPT_WINDOW| Run TAD boundaries search using windows grid for chrm {}...".format(ch))
+
+    df_bsc_parts = {x: [] for x in bs_grid}  # key: bs_threshold, value: segmentations for each window
+    opt_windows_bsc = {}  # key: bs_threshold, value: opt window
+    boundaries_cache = {}  # boundaries for each window are shared between all boundary strength thresholds
+    stats_bsc = {x: {} for x in bs_grid}  # key: bs_threshold, value: stats for each window
+
+    # loop for boundary strength param
+    for bsg in bs_grid:
+        logging.info("SEARCH_OPT_WINDOW| Run TAD boundaries search for boundary strength threshold {}...".format(bsg))
+        boundaries_coords_0, boundaries_0 = produce_boundaries_segmentation(clr, mtx, filters, grid[0],
+                                                                            ch,
+                                                                            method, resolution, k, final=False,
+                                                                            bsg=bsg, cache=boundaries_cache)
+        mean_tad_size_prev, sum_cov_prev, mean_ins_prev, mean_bsc_prev, full_ins_prev, full_bsc_prev = \
+            calc_mean_tad_size(boundaries_0, filters, ch, mis, mts, grid[0], resolution)
+
+        window_prev = grid[0]
+
+        f_ins_prev = full_ins_prev
+        f_bsc_prev = full_bsc_prev
+
+        ins_prev = mean_ins_prev
+        bsc_prev = mean_bsc_prev
+        cov_prev = sum_cov_prev
+        bound_count_prev = len(boundaries_coords_0)
+
+        stats_bsc[bsg][grid[0]] = (mean_tad_size_prev, cov_prev, bound_count_prev, ins_prev, bsc_prev)
+
+        df_tmp = pd.DataFrame({'bgn': boundaries_coords_0[:, 0], 'end': boundaries_coords_0[:, 1], 'bs_threshold': bsg,
+                               'window': grid[0], 'ch': ch, 'insulation_score': f_ins_prev,
+                               'boundary_strength': f_bsc_prev})
+        df_bsc_parts[bsg].append(df_tmp)
+
+        local_optimas = {}
+        mean_tad_sizes = []
+        covs = []
+        mean_tad_sizes.append(mean_tad_size_prev)
+        covs.append(cov_prev)
+        ins = []
+        ins.append(ins_prev)
+        bsc = []
+        bsc.append(bsc_prev)
+        bounds_cnt = deque(maxlen=window_eps)  # ring buffer of the last window_eps boundaries counts
+        bounds_cnt.append(bound_count_prev)
+
+        is_exp_tad_cnt_reached = False
+        is_exp_tad_size_reached = False
+
+        for window in grid[1:]:
+            boundaries_coords, boundaries = produce_boundaries_segmentation(clr, mtx, filters, window,
+                                                                            ch,
+                                                                            method, resolution, k, final=False,
+                                                                            bsg=bsg, cache=boundaries_cache)
+            mean_tad_size, sum_cov, mean_ins, mean_bsc, full_ins, full_bsc = calc_mean_tad_size(boundaries, filters,
+                                                                                                ch, mis, mts,
+                                                                                                window, resolution)
+
+            mean_tad_sizes.append(mean_tad_size)
+            cov = sum_cov
+            covs.append(cov)
+            ins.append(mean_ins)
+            bsc.append(mean_bsc)
+            bound_count = len(boundaries_coords)
+            bounds_cnt.append(bound_count)
+
+            stats_bsc[bsg][window] = (mean_tad_size, cov, bound_count, mean_ins, mean_bsc)
+
+            df_tmp = pd.DataFrame({'bgn': boundaries_coords[:, 0], 'end': boundaries_coords[:, 1], 'bs_threshold': bsg,
+                                   'window': window, 'ch': ch, 'insulation_score': full_ins,
+                                   'boundary_strength': full_bsc})
+            df_bsc_parts[bsg].append(df_tmp)
+
+            if (mean_tad_size - expected_bins) * (mean_tad_size_prev - expected_bins) <= 0:
+                is_exp_tad_size_reached = True
+                if abs(mean_tad_size - expected_bins) <= abs(mean_tad_size_prev - expected_bins):
+                    local_optimas[window] = cov
+                else:
+                    local_optimas[window_prev] = cov_prev
+
+            if (bound_count_prev - tads_expected_cnt) * (bound_count - tads_expected_cnt) <= 0:
+                is_exp_tad_cnt_reached = True
+
+            if is_exp_tad_size_reached and is_exp_tad_cnt_reached and len(bounds_cnt) >= window_eps:
+                window_cnts = np.asarray(bounds_cnt, dtype=np.float64)
+                window_cnts = abs(window_cnts - tads_expected_cnt)
+                # add "and window > 150000" in the end of below if-condition if you want to limit output to the certain
+                # window value:
+                if np.mean(abs(window_cnts[:-1] - window_cnts[-1]) / window_cnts[-1]) < eps:
+                    break
+
+            window_prev = window
+            cov_prev = cov
+            mean_tad_size_prev = mean_tad_size
+            bound_count_prev = bound_count
+
+        closest_idx = int(np.argmin(np.abs(np.asarray(mean_tad_sizes, dtype=np.float64) - expected_bins)))
+        local_optimas[grid[closest_idx]] = covs[closest_idx]
+        opt_window = max(local_optimas.items(), key=operator.itemgetter(1))[0]
+        opt_windows_bsc[bsg] = opt_window
+
+        logging.info("SEARCH_OPT_WINDOW| Found optimal window for chrm {} and boundary strength threshold {}: {}".format(ch, bsg, opt_window))
+        _, _ = produce_boundaries_segmentation(clr, mtx, filters, opt_window, ch, method, resolution, k,
+                                               final=True, bsg=bsg, cache=boundaries_cache)
+        logging.info("SEARCH_OPT_WINDOW| End boundary strength threshold {}".format(bsg))
+
+    bsc_list = []
+    mts_list = []
+    for bsg in bs_grid:
+        bsc_list.append(stats_bsc[bsg][opt_windows_bsc[bsg]][-1])
+        # print(stats_bsc[bsg][opt_windows_bsc[bsg]][0])
+        mts_list.append(abs(stats_bsc[bsg][opt_windows_bsc[bsg]][0] - expected_bins))
+    bsc_list, mts_list, bs_grid_new = zip(*sorted(zip(bsc_list, mts_list, bs_grid), reverse=True))
+    bsc_list = list(bsc_list)
+    mts_list = list(mts_list)
+    bs_grid_new = list(bs_grid_new)
+
+    # print(mts_list)
+    # print(bsc_list)
+    # print(bs_grid_new)
+
+    for i in range(1, len(mts_list) - 1):
+        if mts_list[i] < mts_list[i - 1] and mts_list[i] < mts_list[i + 1]:
+            #logging.info(mts_list[i])
+            if mts_list[i] < 1:  # Now less than 1 bin of Hi-C map -- should be adjusted in order to depend on expected TAD size)
+                best_index = i
+                break
+    #logging.info(np.argmin(mts_list))
+    #logging.info(bs_grid_new[np.argmin(mts_list)])
+    # best_index = np.argmin(mts_list)
+    try:
+        best_boundary_strength_threshold = bs_grid_new[best_index]
+    except:
+        best_boundary_strength_threshold = bs_grid_new[np.argmin(mts_list)]
+
+    if best_boundary_strength_threshold < 0.2:
+        logging.warning('SEARCH_OPT_WINDOW| WARNING! Your expected TAD size parameter value is probably too low! '
+                        'The subsequent borders annotation might be incorrect! Please, choose another one (higher)')
+    elif best_boundary_strength_threshold >= 0.8:
+        logging.warning('SEARCH_OPT_WINDOW| WARNING! Your expected TAD size parameter value is probably too high! '
+                        'The subsequent borders annotation might be incorrect! Please, choose another one (lower)')
+
+    logging.info('SEARCH_OPT_WINDOW| For stage {} for chrom {} boundary strength percentile is {}'.format(exp, ch,
+                                                                                                          best_boundary_strength_threshold))
+    # best_boundary_strength_threshold = bs_grid[np.argmax(bsc_list)]
+    best_window = opt_windows_bsc[best_boundary_strength_threshold]
+
+    sub_df = pd.concat(df_bsc_parts[best_boundary_strength_threshold], ignore_index=True)
+
+    logging.info("SEARCH_OPT_WINDOW| End chromosome {}".format(ch))
+
+    return sub_df, stats_bsc[best_boundary_strength_threshold], best_window
+
+
 def search_opt_window(datasets, cool_sets, experiment_path, grid, mis, mts, chrms, method, resolution, expected=120000,
                       exp='3-4h', percentile=99.9, eps=0.05, window_eps=5, k=3, filtration='auto', bs_thresholds=None,
-                      bs_thresholds_grid=None):
+                      bs_thresholds_grid=None, n_jobs=-1):
     """
     Function to search optimal window for each chromosome. This function only for use in case of method='insulation'!
     :param datasets: python dictionary with loaded chromosomes and stages.
@@ -144,6 +367,8 @@ def search_opt_window(datasets, cool_sets, experiment_path, grid, mis, mts, chrm
     :param percentile: percentile for cooler preparations and Hi-C vizualization.
     Normally should be 99.9, but you could set another value.
     :param window_eps: number of previous window value to be averaged for stopping criterion.
+    :param n_jobs: number of processes to search optimal window for chromosomes in parallel (-1 -- all cores).
+    Set n_jobs=1 to run sequentially and keep logs of each chromosome.
     :return: python dictionary with optimal window values for each chromosome, dataframe with segmentation for all
     window values in given range, dataframe with segmentation for optimal window values and dictionary with stats for
     each chromosome.
@@ -161,182 +386,15 @@ def search_opt_window(datasets, cool_sets, experiment_path, grid, mis, mts, chrm
 
     logging.info("SEARCH_OPT_WINDOW| Start search optimal segmentation...")
     time_start = time.time()
-    for ch in chrms:
-        logging.info("SEARCH_OPT_WINDOW| Start chromosome {}".format(ch))
-
-        filters, mtx, good_bins = get_noisy_stripes(datasets, ch, method, resolution, exp, percentile=percentile)
-
-        all_bins_cnt = good_bins.shape[0]
-        good_bins_cnt = good_bins[good_bins == True].shape[0]
-        tads_expected_cnt = good_bins_cnt // (expected / resolution)
-
-        logging.info("SEARCH_OPT_WINDOW| For chrm {} of shape {} bins we have {} good bins and {} expected count of "
-                     "TADs (according to expected TAD size)".format(ch, all_bins_cnt, good_bins_cnt, tads_expected_cnt))
-        logging.info("SEARCH_OPT_WINDOW| Run TAD boundaries search using windows grid for chrm {}...".format(ch))
-
-        df_bsc = pd.DataFrame(
-            columns=['bgn', 'end', 'bs_threshold', 'window', 'ch', 'insulation_score', 'boundary_strength'])
-        opt_windows_bsc = {}  # key: bs_threshold, value: opt window
-        stats_bsc = {x: {} for x in bs_grid}  # key: bs_threshold, value: stats for each window
-
-        # loop for boundary strength param
-        for bsg in bs_grid:
-            logging.info("SEARCH_OPT_WINDOW| Run TAD boundaries search for boundary strength threshold {}...".format(bsg))
-            boundaries_coords_0, boundaries_0 = produce_boundaries_segmentation(cool_sets[exp], mtx, filters, grid[0],
-                                                                                ch,
-                                                                                method, resolution, k, final=False,
-                                                                                bsg=bsg)
-            mean_tad_size_prev, sum_cov_prev, mean_ins_prev, mean_bsc_prev, full_ins_prev, full_bsc_prev = \
-                calc_mean_tad_size(boundaries_0, filters, ch, mis, mts, grid[0], resolution)
-
-            window_prev = grid[0]
-
-            f_ins_prev = full_ins_prev
-            f_bsc_prev = full_bsc_prev
-
-            ins_prev = mean_ins_prev
-            bsc_prev = mean_bsc_prev
-            cov_prev = sum_cov_prev
-            bound_count_prev = len(boundaries_coords_0)
-
-            stats_bsc[bsg][grid[0]] = (mean_tad_size_prev, cov_prev, bound_count_prev, ins_prev, bsc_prev)
-
-            df_tmp = pd.DataFrame(columns=['bgn', 'end', 'bs_threshold', 'window', 'ch', 'insulation_score',
-                                           'boundary_strength'], index=np.arange(len(boundaries_coords_0)))
-            df_tmp.loc[:, ['bgn', 'end']] = boundaries_coords_0
-            df_tmp['bs_threshold'] = bsg
-            df_tmp['window'] = grid[0]
-            df_tmp['ch'] = ch
-            df_tmp.loc[:, 'insulation_score'] = f_ins_prev
-            df_tmp.loc[:, 'boundary_strength'] = f_bsc_prev
-            df_bsc = pd.concat([df_bsc, df_tmp])
-
-            local_optimas = {}
-            mean_tad_sizes = []
-            covs = []
-            mean_tad_sizes.append(mean_tad_size_prev)
-            covs.append(cov_prev)
-            ins = []
-            ins.append(ins_prev)
-            bsc = []
-            bsc.append(bsc_prev)
-            bounds_cnt = []
-            bounds_cnt.append(bound_count_prev)
-
-            is_exp_tad_cnt_reached = False
-            is_exp_tad_size_reached = False
-
-            for window in grid[1:]:
-                boundaries_coords, boundaries = produce_boundaries_segmentation(cool_sets[exp], mtx, filters, window,
-                                                                                ch,
-                                                                                method, resolution, k, final=False,
-                                                                                bsg=bsg)
-                mean_tad_size, sum_cov, mean_ins, mean_bsc, full_ins, full_bsc = calc_mean_tad_size(boundaries, filters,
-                                                                                                    ch, mis, mts,
-                                                                                                    window, resolution)
-
-                mean_tad_sizes.append(mean_tad_size)
-                cov = sum_cov
-                covs.append(cov)
-                ins.append(mean_ins)
-                bsc.append(mean_bsc)
-                bound_count = len(boundaries_coords)
-                bounds_cnt.append(bound_count)
-
-                stats_bsc[bsg][window] = (mean_tad_size, cov, bound_count, mean_ins, mean_bsc)
-
-                df_tmp = pd.DataFrame(columns=['bgn', 'end', 'bs_threshold', 'window', 'ch', 'insulation_score',
-                                               'boundary_strength'], index=np.arange(len(boundaries_coords)))
-                df_tmp.loc[:, ['bgn', 'end']] = boundaries_coords
-                df_tmp['window'] = window
-                df_tmp['bs_threshold'] = bsg
-                df_tmp['ch'] = ch
-                df_tmp.loc[:, 'insulation_score'] = full_ins
-                df_tmp.loc[:, 'boundary_strength'] = full_bsc
-                df_bsc = pd.concat([df_bsc, df_tmp])
-
-                if (mean_tad_size - expected / resolution) * (mean_tad_size_prev - expected / resolution) <= 0:
-                    is_exp_tad_size_reached = True
-                    if abs(mean_tad_size - expected / resolution) <= abs(mean_tad_size_prev - expected / resolution):
-                        local_optimas[window] = cov
-                    else:
-                        local_optimas[window_prev] = cov_prev
-
-                if (bound_count_prev - tads_expected_cnt) * (bound_count - tads_expected_cnt) <= 0:
-                    is_exp_tad_cnt_reached = True
-
-                if is_exp_tad_size_reached and is_exp_tad_cnt_reached and len(
-                        [x for x in bounds_cnt if str(x) != 'nan']) >= window_eps:
-                    window_cnts = np.asarray([x for x in bounds_cnt if str(x) != 'nan'][-window_eps:])
-                    window_cnts = abs(window_cnts - tads_expected_cnt)
-                    # add "and window > 150000" in the end of below if-condition if you want to limit output to the certain
-                    # window value:
-                    if np.mean(abs(window_cnts[:-1] - window_cnts[-1]) / window_cnts[-1]) < eps:
-                        break
-
-                window_prev = window
-                cov_prev = cov
-                mean_tad_size_prev = mean_tad_size
-                bound_count_prev = bound_count
-
-            local_optimas[grid[np.argmin([abs(x - expected / resolution) for x in mean_tad_sizes])]] = covs[
-                np.argmin([abs(x - expected / resolution) for x in mean_tad_sizes])]
-            opt_window = max(local_optimas.items(), key=operator.itemgetter(1))[0]
-            opt_windows_bsc[bsg] = opt_window
-
-            logging.info("SEARCH_OPT_WINDOW| Found optimal window for chrm {} and boundary strength threshold {}: {}".format(ch, bsg, opt_window))
-            _, _ = produce_boundaries_segmentation(cool_sets[exp], mtx, filters, opt_window, ch, method, resolution, k,
-                                                   final=True, bsg=bsg)
-            logging.info("SEARCH_OPT_WINDOW| End boundary strength threshold {}".format(bsg))
-
-        bsc_list = []
-        mts_list = []
-        for bsg in bs_grid:
-            bsc_list.append(stats_bsc[bsg][opt_windows_bsc[bsg]][-1])
-            # print(stats_bsc[bsg][opt_windows_bsc[bsg]][0])
-            mts_list.append(abs(stats_bsc[bsg][opt_windows_bsc[bsg]][0] - expected / resolution))
-        bsc_list, mts_list, bs_grid_new = zip(*sorted(zip(bsc_list, mts_list, bs_grid), reverse=True))
-        bsc_list = list(bsc_list)
-        mts_list = list(mts_list)
-        bs_grid_new = list(bs_grid_new)
-
-        # print(mts_list)
-        # print(bsc_list)
-        # print(bs_grid_new)
-
-        for i in range(1, len(mts_list) - 1):
-            if mts_list[i] < mts_list[i - 1] and mts_list[i] < mts_list[i + 1]:
-                #logging.info(mts_list[i])
-                if mts_list[i] < 1:  # Now less than 1 bin of Hi-C map -- should be adjusted in order to depend on expected TAD size)
-                    best_index = i
-                    break
-        #logging.info(np.argmin(mts_list))
-        #logging.info(bs_grid_new[np.argmin(mts_list)])
-        # best_index = np.argmin(mts_list)
-        try:
-            best_boundary_strength_threshold = bs_grid_new[best_index]
-        except:
-            best_boundary_strength_threshold = bs_grid_new[np.argmin(mts_list)]
-
-        if best_boundary_strength_threshold < 0.2:
-            logging.warning('SEARCH_OPT_WINDOW| WARNING! Your expected TAD size parameter value is probably too low! '
-                            'The subsequent borders annotation might be incorrect! Please, choose another one (higher)')
-        elif best_boundary_strength_threshold >= 0.8:
-            logging.warning('SEARCH_OPT_WINDOW| WARNING! Your expected TAD size parameter value is probably too high! '
-                            'The subsequent borders annotation might be incorrect! Please, choose another one (lower)')
-
-        logging.info('SEARCH_OPT_WINDOW| For stage {} for chrom {} boundary strength percentile is {}'.format(exp, ch,
-                                                                                                              best_boundary_strength_threshold))
-        # best_boundary_strength_threshold = bs_grid[np.argmax(bsc_list)]
-        best_window = opt_windows_bsc[best_boundary_strength_threshold]
-        stats[ch] = stats_bsc[best_boundary_strength_threshold]
+    results = Parallel(n_jobs=n_jobs, backend='loky')(
+        delayed(_search_opt_window_chrom)(ch, {exp: {ch: datasets[exp][ch]}}, cool_sets[exp], grid, mis, mts, method,
+                                          resolution, expected, exp, percentile, eps, window_eps, k, bs_grid)
+        for ch in chrms)
+    for ch, (sub_df, stats_ch, best_window) in zip(chrms, results):
+        stats[ch] = stats_ch
         opt_windows[ch] = best_window
-
-        sub_df = df_bsc[df_bsc.bs_threshold == best_boundary_strength_threshold]
-        sub_df.index = list(range(sub_df.shape[0]))
-        df = pd.concat([df, sub_df])
-
-        logging.info("SEARCH_OPT_WINDOW| End chromosome {}".format(ch))
+        logging.info("SEARCH_OPT_WINDOW| Optimal window for chrm {}: {}".format(ch, best_window))
+    df = pd.concat([df] + [sub_df for sub_df, _, _ in results])
 
     df.loc[:, 'window'] = df.window.values.astype(int)
     df.loc[:, 'bs_threshold'] = df.bs_threshold.values.astype(float)
@@ -346,10 +404,7 @@ def search_opt_window(datasets, cool_sets, experiment_path, grid, mis, mts, chrm
     df.loc[:, 'boundary_strength'] = df.boundary_strength.values.astype(float)
     df.reset_index(drop=True, inplace=True)
 
-    df_opt = pd.DataFrame(columns=['bgn', 'end', 'bs_threshold', 'window', 'ch', 'insulation_score', 'boundary_strength'])
-    for ch in chrms:
-        df_opt = pd.concat([df_opt, df[(df['ch'] == ch) & (df['window'] == opt_windows[ch])]])
-    df_opt.reset_index(drop=True, inplace=True)
+    df_opt = df[df['window'].values == df['ch'].map(opt_windows).values].reset_index(drop=True)
 
     df.to_csv(join(experiment_path, "all_tads_{}_{}_{}kb_{}kb.csv".format(exp, method, int(expected / 1000),
                                                                           int(resolution / 1000))), sep='\t')
@@ -366,8 +421,41 @@ def search_opt_window(datasets, cool_sets, experiment_path, grid, mis, mts, chrm
     return df, df_opt, stats, opt_windows
 
 
+def _search_opt_gamma_chrom(ch, datasets, method, grid, mis, mts, start_step, eps, expected, exp, resolution,
+                            percentile):
+    """
+    Function to search optimal gamma for a single chromosome. It is a worker of search_opt_gamma function.
+    :param ch: chromosome of interest.
+    :param datasets: python dictionary with loaded chromosomes and stages (at least stage exp for chromosome ch).
+    Other parameters are the same as in search_opt_gamma function.
+    :return: dataframe with segmentation for all gamma values in adjusted grid, dataframe with segmentation for
+    optimal gamma value and optimal gamma value.
+    """
+    logging.info("SEARCH_OPT_GAMMA| Start chromosome {}".format(ch))
+
+    df = pd.DataFrame(columns=['bgn', 'end', 'gamma', 'method', 'ch'])
+    df_concretized = pd.DataFrame(columns=['bgn', 'end', 'gamma', 'method', 'ch'])
+
+    filters, mtx, good_bins = get_noisy_stripes(datasets, ch, method, resolution, exp=exp, percentile=percentile)
+    check_mtx(mtx)
+    segmentation_cache = {}  # segmentations for each gamma are shared between all steps of the gamma search
+    whether_to_expand(mtx, filters, grid, ch, good_bins, method, mis, mts, start_step, cache=segmentation_cache)
+    adj_grid = adjust_boundaries(mtx, filters, grid, ch, good_bins, method, mis, mts, start_step, eps=eps,
+                                 type='upper', cache=segmentation_cache)
+    adj_grid = adjust_boundaries(mtx, filters, adj_grid, ch, good_bins, method, mis, mts, start_step, eps=eps,
+                                 type='lower', cache=segmentation_cache)
+    df, opt_gamma = find_global_optima(mtx, filters, adj_grid, ch, good_bins, method, mis, mts, start_step, df, expected, resolution,
+                                       cache=segmentation_cache)
+    df_concretized, opt_gammas = adjust_global_optima(mtx, filters, opt_gamma, {}, ch, good_bins, method, mis, mts, start_step, df_concretized, expected, resolution, eps=eps,
+                                                      cache=segmentation_cache)
+
+    logging.info("SEARCH_OPT_GAMMA| End chromosome {}".format(ch))
+
+    return df, df_concretized, opt_gammas[ch]
+
+
 def search_opt_gamma(datasets, experiment_path, method, grid, mis, mts, start_step, chrms, eps=1e-2, expected=120000,
-                     exp='3-4h', resolution=5000, percentile=99.9):
+                     exp='3-4h', resolution=5000, percentile=99.9, n_jobs=-1):
     """
     Function to search optimal gamma for each chromosome
     :param datasets: python dictionary with loaded chromosomes and stages.
@@ -387,6 +475,8 @@ def search_opt_gamma(datasets, experiment_path, method, grid, mis, mts, start_st
     :param resolution: Hi-C resolution of your coolfiles.
     :param percentile: percentile for cooler preparations and Hi-C vizualization.
     Normally should be 99.9, but you could set another value.
+    :param n_jobs: number of processes to search optimal gamma for chromosomes in parallel (-1 -- all cores).
+    Set n_jobs=1 to run sequentially and keep logs of each chromosome.
     :return: python dictionary with optimal gamma values for each chromosome, dataframe with segmentation for all
     gamma values in given range, dataframe with segmentation for optimal gamma values.
     """
@@ -396,19 +486,15 @@ def search_opt_gamma(datasets, experiment_path, method, grid, mis, mts, start_st
 
     logging.info("SEARCH_OPT_GAMMA| Start search optimal segmentation...")
     time_start = time.time()
-    for ch in chrms:
-        logging.info("SEARCH_OPT_GAMMA| Start chromosome {}".format(ch))
-
-        filters, mtx, good_bins = get_noisy_stripes(datasets, ch, method, resolution, exp=exp, percentile=percentile)
-        whether_to_expand(mtx, filters, grid, ch, good_bins, method, mis, mts, start_step)
-        adj_grid = adjust_boundaries(mtx, filters, grid, ch, good_bins, method, mis, mts, start_step, eps=eps,
-                                     type='upper')
-        adj_grid = adjust_boundaries(mtx, filters, adj_grid, ch, good_bins, method, mis, mts, start_step, eps=eps,
-                                     type='lower')
-        df, opt_gamma = find_global_optima(mtx, filters, adj_grid, ch, good_bins, method, mis, mts, start_step, df, expected, resolution)
-        df_concretized, opt_gammas = adjust_global_optima(mtx, filters, opt_gamma, opt_gammas, ch, good_bins, method, mis, mts, start_step, df_concretized, expected, resolution, eps=eps)
-
-        logging.info("SEARCH_OPT_GAMMA| End chromosome {}".format(ch))
+    results = Parallel(n_jobs=n_jobs, backend='loky')(
+        delayed(_search_opt_gamma_chrom)(ch, {exp: {ch: datasets[exp][ch]}}, method, grid, mis, mts, start_step, eps,
+                                         expected, exp, resolution, percentile)
+        for ch in chrms)
+    for ch, (_, _, opt_gamma) in zip(chrms, results):
+        opt_gammas[ch] = opt_gamma
+        logging.info("SEARCH_OPT_GAMMA| Optimal gamma for chrm {}: {}".format(ch, opt_gamma))
+    df = pd.concat([df] + [df_ch for df_ch, _, _ in results])
+    df_concretized = pd.concat([df_concretized] + [df_conc_ch for _, df_conc_ch, _ in results])
 
     df.loc[:, 'gamma'] = df.gamma.values.astype(float)
     df.loc[:, 'bgn'] = df.bgn.values.astype(int)
@@ -439,7 +525,7 @@ def search_opt_gamma(datasets, experiment_path, method, grid, mis, mts, start_st
 
 def run_consensus(datasets, cool_sets, experiment_path, grid, mis, mts, chrms, method, resolution, expected=120000,
                       exp='nuclear_cycle_14, 3-4h', percentile=99.9, eps=0.05, window_eps=5, merge_boundaries=False,
-                  k=3, loc_size=2, N=4, filtration='auto', bs_thresholds=None, bs_thresholds_grid=None):
+                  k=3, loc_size=2, N=4, filtration='auto', bs_thresholds=None, bs_thresholds_grid=None, n_jobs=-1):
     """
     Function to search consensus set of boundaries among given set of stages (indicated in exp parameter)
     :param datasets: python dictionary with loaded chromosomes and stages.
@@ -460,6 +546,7 @@ def run_consensus(datasets, cool_sets, experiment_path, grid, mis, mts, chrms, m
     :param percentile: percentile for cooler preparations and Hi-C vizualization.
     Normally should be 99.9, but you could set another value.
     :param merge_boundaries: whether to merge close boundaries into a single one (True or False)
+    :param n_jobs: number of processes to search optimal window for chromosomes in parallel (-1 -- all cores).
     :return: python dictionary with optimal gamma values for each chromosome, dataframe with segmentation for all
     gamma values in given range, dataframe with segmentation for optimal gamma values.
     """
@@ -476,7 +563,7 @@ def run_consensus(datasets, cool_sets, experiment_path, grid, mis, mts, chrms, m
         df, df_conc, stats, opws = search_opt_window(datasets, cool_sets, experiment_path, grid, mis, mts, chrms,
                                                      method, resolution, expected, stage, percentile, eps,
                                                      window_eps, k, filtration=filtration, bs_thresholds=bs_thresholds,
-                                                     bs_thresholds_grid=bs_thresholds_grid)
+                                                     bs_thresholds_grid=bs_thresholds_grid, n_jobs=n_jobs)
         df['stage'] = stage
         df_conc['stage'] = stage
         df_all = pd.concat([df_all, df], ignore_index=True)
@@ -497,15 +584,14 @@ def run_consensus(datasets, cool_sets, experiment_path, grid, mis, mts, chrms, m
         for ch in chrms:
             filters, mtx, good_bins = get_noisy_stripes(datasets, ch, method, resolution, stage, percentile=percentile)
             filters_final[stage][ch] = filters[ch]
-    indices_selected = []
     logging.info("RUN_CONSENSUS| Before filtering we have {} consensus boundaries in total".format(df_opt_all.shape[0]))
-    for idx in range(df_opt_all.shape[0]):
-        if not whether_tad_noisy(np.asarray(df_opt_all.loc[idx][['bgn', 'end']]),
-                            filters_final[df_opt_all.loc[idx]['stage']],
-                            df_opt_all.loc[idx]['ch'], method='insulation', resolution=resolution, k=k):
-            indices_selected.append(idx)
-    df_opt_all = df_opt_all.loc[indices_selected]
-    df_opt_all.index = list(range(df_opt_all.shape[0]))
+    # boundaries of each stage and chromosome are checked against the corresponding noisy stripes at once
+    is_noisy = np.zeros(df_opt_all.shape[0], dtype=bool)
+    coords = df_opt_all[['bgn', 'end']].values.astype(np.float64)
+    for (stage, ch), idx in df_opt_all.groupby(['stage', 'ch']).indices.items():
+        is_noisy[idx] = whether_tad_noisy_batch(coords[idx], filters_final[stage], ch, method='insulation',
+                                                resolution=resolution, k=k)
+    df_opt_all = df_opt_all[~is_noisy].reset_index(drop=True)
     logging.info("RUN_CONSENSUS| After filtering we have {} consensus boundaries in total".format(df_opt_all.shape[0]))
     logging.info("RUN_CONSENSUS| End filtering consensus boundaries...")
 
@@ -694,20 +780,22 @@ def viz_opt_curves(df, method, chromnames, expected_mts, mts, data_path, opt_df,
     :param data_path: path to experiment's directory.
     :return: nothing
     """
+    if method != 'insulation':
+        curves = df.groupby(['ch', 'gamma'])['length'].agg(['mean', 'count', 'sum']).reset_index()
+        curves_by_ch = dict(list(curves.groupby('ch')))
+
     for ch in chromnames:
         if method == 'insulation':
             od = collections.OrderedDict(sorted(df[ch].items()))
-            gr_mean = [od[i][0] for i in od]
-            # gr_cov = [od[i][1] for i in od]
-            # gr_count = [od[i][2] for i in od]
-            gr_ins = [od[i][3] for i in od]
-            gr_bsc = [od[i][4] for i in od]
-            w_range = [i for i in od]
+            vals = np.array(list(od.values()))
+            gr_mean = vals[:, 0]
+            # gr_cov = vals[:, 1]
+            # gr_count = vals[:, 2]
+            gr_ins = vals[:, 3]
+            gr_bsc = vals[:, 4]
+            w_range = list(od)
         else:
-            gr_mean = df.query('ch=="{}"'.format(ch)).groupby(['gamma', 'ch']).mean().reset_index().sort_values(['ch', 'gamma'])
-            gr_count = df.query('ch=="{}"'.format(ch)).groupby(['gamma', 'ch']).count().reset_index().sort_values(
-                ['ch', 'gamma'])
-            gr_cov = df.query('ch=="{}"'.format(ch)).groupby(['gamma', 'ch']).sum().reset_index().sort_values(['ch', 'gamma'])
+            curves_ch = curves_by_ch[ch]
 
         plt.figure(figsize=[10, 5])
         host = host_subplot(111, axes_class=AA.Axes)
@@ -743,12 +831,12 @@ def viz_opt_curves(df, method, chromnames, expected_mts, mts, data_path, opt_df,
             p2, = par1.plot(w_range, gr_ins, label="{} mean insulation score".format(ch))
             p3, = par2.plot(w_range, gr_bsc, label="{} mean B-score".format(ch))
         else:
-            p1, = host.plot(gr_mean.gamma, gr_mean.length, label="{} mean TAD size".format(ch))
-            p1, = host.plot([min(df[df['ch'] == ch]['gamma']), max(df[df['ch'] == ch]['gamma'])], [expected_mts, expected_mts],
+            p1, = host.plot(curves_ch['gamma'], curves_ch['mean'], label="{} mean TAD size".format(ch))
+            p1, = host.plot([curves_ch['gamma'].min(), curves_ch['gamma'].max()], [expected_mts, expected_mts],
                             color=p1.get_color())
-            p2, = par1.plot(gr_cov.gamma, gr_cov.length, label="{} coverage".format(ch))
-            p3, = par2.plot(gr_count.gamma, gr_count.length, label="{} count".format(ch))
-            host.set_ylim([0, max(gr_mean.length)])
+            p2, = par1.plot(curves_ch['gamma'], curves_ch['sum'], label="{} coverage".format(ch))
+            p3, = par2.plot(curves_ch['gamma'], curves_ch['count'], label="{} count".format(ch))
+            host.set_ylim([0, curves_ch['mean'].max()])
 
         host.axis["left"].label.set_color(p1.get_color())
         par1.axis["left"].label.set_color(p2.get_color())
@@ -760,8 +848,64 @@ def viz_opt_curves(df, method, chromnames, expected_mts, mts, data_path, opt_df,
         else:
             plt.title('Stage {}, Chr {}, Method: {}, expected TAD size: {} Kb, optimal gamma: {}'.format(stage,
                 ch, method, str(mts), list(set(opt_df[opt_df.ch == ch]['gamma']))[0] // resolution))
-        plt.draw()
         plt.savefig(join(data_path, stage + '_' + ch + '_' + method + '_' + str(mts) + 'Kb' + '.png'), bbox_inches='tight')
+        plt.close()
+
+
+def _tads_lines(segments, resolution, begin, end, is_insulation, shifts=0):
+    """
+    Function to build lines that outline TADs (or boundaries in case of insulation) in the vizualized region of Hi-C map.
+    :param segments: 2D numpy array where segments[:, 0] are segment starts and segments[:, 1] are segment ends.
+    :param resolution: Hi-C resolution of your coolfiles.
+    :param begin: first bin of the vizualized region.
+    :param end: last bin of the vizualized region.
+    :param is_insulation: True if segments are boundaries (in bp) produced by insulation method, False otherwise (in bins).
+    :param shifts: shift (in bins) of the outline for each boundary. Only for insulation.
+    :return: bool mask of segments that fall into the region and 4D numpy array of lines with shape
+    (number of segments in region, number of lines per segment, 2, 2).
+    """
+    if is_insulation:
+        bgn, fin = segments[:, 0] / resolution, segments[:, 1] / resolution
+        mask = (np.trunc(bgn) < end) & (np.trunc(fin) > begin)
+        bgn, fin, shifts = bgn[mask], fin[mask], (shifts[mask] if np.ndim(shifts) else shifts)
+        lines = np.array([[[np.trunc(bgn + shifts), np.trunc(bgn - shifts)], [np.trunc(fin + shifts), np.trunc(bgn - shifts)]],
+                          [[np.trunc(fin + shifts), np.trunc(bgn - shifts)], [np.trunc(fin + shifts), np.trunc(fin - shifts)]],
+                          [[np.trunc(bgn + shifts), np.trunc(bgn + 1 - shifts)], [np.trunc(fin + shifts), np.trunc(bgn + 1 - shifts)]],
+                          [[np.trunc(fin - 1 + shifts), np.trunc(bgn - shifts)], [np.trunc(fin - 1 + shifts), np.trunc(fin - shifts)]]])
+    else:
+        mask = (segments[:, 0] < end) & (segments[:, 1] > begin)
+        bgn, fin = segments[mask, 0], segments[mask, 1]
+        lines = np.array([[[bgn, bgn], [fin, bgn]],
+                          [[fin, bgn], [fin, fin]]])
+    return mask, np.moveaxis(lines, -1, 0).reshape(-1, lines.shape[0], 2, 2) - begin
+
+
+def _sparse_nanpercentile(mtx, percentile):
+    """
+    Function to compute percentile of sparse Hi-C matrix with removed diagonal ignoring NaNs. It gives the same value
+    as np.nanpercentile on the dense matrix, but implicit zeros are accounted for by their count only.
+    :param mtx: scipy.sparse matrix of Hi-C contacts.
+    :param percentile: percentile to compute.
+    :return: percentile value.
+    """
+    coo = mtx.tocoo()
+    vals = coo.data[coo.row != coo.col]
+    is_nan = np.isnan(vals)
+    vals = np.sort(vals[~is_nan])
+    n_total = mtx.shape[0] * mtx.shape[1] - is_nan.sum()
+    n_zeros = n_total - len(vals)
+    zeros_pos = np.searchsorted(vals, 0)
+
+    def nth(k):
+        if k < zeros_pos:
+            return vals[k]
+        elif k < zeros_pos + n_zeros:
+            return 0.0
+        return vals[k - n_zeros]
+
+    pos = (n_total - 1) * percentile / 100.0
+    lo, hi = int(math.floor(pos)), int(math.ceil(pos))
+    return nth(lo) + (nth(hi) - nth(lo)) * (pos - lo)
 
 
 def viz_tads(data_path, df, datasets, chromnames, exp, resolution, method=None, is_insulation=False, clusters=False, colors=None, percentile=99.9, vbc=1000, consensus=False):
@@ -795,140 +939,82 @@ def viz_tads(data_path, df, datasets, chromnames, exp, resolution, method=None,
             hexes = colors_consensus.as_hex()
             logging.info("Stages color encoding for visualization: {}".format(
                 str([(list_of_stages[i], color_dict[hex_]) for i, hex_ in enumerate(hexes)])))
+            lof_sorted = sorted(list_of_stages, reverse=True)
+            if any([stg.startswith('3-4h') for stg in list_of_stages]):
+                lof_sorted = [lof_sorted[-1]] + lof_sorted[:-1]
+            lof_dict = {stage_lof: i_d for i_d, stage_lof in enumerate(lof_sorted)}
 
+    df_by_ch = dict(list(df.groupby('ch')))
     for ch in chromnames:
-        mtx_size = datasets[exp][ch].shape[0]
+        df_tmp = df_by_ch.get(ch, df.iloc[:0])
+        segments = df_tmp[['bgn', 'end']].values
+        mtx_cor = datasets[exp][ch]
+        if scipy.sparse.issparse(mtx_cor):
+            vmax = _sparse_nanpercentile(mtx_cor, percentile)
+        else:
+            mtx_cor = mtx_cor.copy()
+            np.fill_diagonal(mtx_cor, 0)
+            vmax = np.nanpercentile(mtx_cor, percentile)
+        mtx_size = mtx_cor.shape[0]
         begin_arr = list(np.arange(0, mtx_size, vbc))
         end_arr = begin_arr[1:]; end_arr.append(mtx_size)
+        # one figure per chromosome, reused (cleared) for every vizualized region
+        fig = Figure(figsize=[20, 20])
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
         for begin, end in zip(begin_arr, end_arr):
-            df_tmp = df.query("ch=='{}'".format(ch))
             # if consensus:
             #     stage_mask = list(map(lambda x: True if ',' not in x else False, list(df_tmp['stage'])))
-            segments = df_tmp[['bgn', 'end']].values
             # if consensus is True and sum(stage_mask) == len(stage_mask):
             #     boundaries_stages = list(df_tmp['stage'])
             #     list_of_stages = list(set(list(df_tmp['stage'])))
             #     dict_of_stages = dict(zip(list_of_stages, list(range(len(list_of_stages)))))
             #     colors_consensus = sns.color_palette('rainbow', len(list_of_stages))
-            mtx_cor = datasets[exp][ch]
-            np.fill_diagonal(mtx_cor, 0)
-            plt.figure(figsize=[20, 20])
-            sns.heatmap(np.log(mtx_cor[begin: end, begin: end] + 1), cmap="Reds", square=True, cbar=False,
-                        vmax=np.nanpercentile(mtx_cor, percentile))
-            plt.xticks([])
-            plt.yticks([])
+            panel = mtx_cor[begin: end, begin: end]
+            if scipy.sparse.issparse(panel):
+                # only the vizualized region is densified
+                panel = panel.toarray()
+                np.fill_diagonal(panel, 0)
+            ax.cla()
+            ax.imshow(np.log1p(panel), cmap="Reds", vmax=vmax, interpolation='nearest',
+                      aspect='equal', extent=(0, end - begin, end - begin, 0))
+            ax.set_xticks([])
+            ax.set_yticks([])
+            sns.despine(ax=ax, left=True, bottom=True)
 
             if clusters:
                 clusters_name = '_'.join(['cluster', method])
-                for l, seg in zip(df_tmp[clusters_name].values, segments):
-                    if is_insulation:
-                        if int(seg[0] / resolution) < end and int(seg[1] / resolution) > begin:
-                            for i in range(1):
-                                plt.plot([int(seg[0] / resolution + i) - begin, int(seg[1] / resolution + i) - begin],
-                                         [int(seg[0] / resolution - i) - begin, int(seg[0] / resolution - i) - begin],
-                                         color=colors[l], linewidth=7, label=str(l))
-                                plt.plot([int(seg[1] / resolution + i) - begin, int(seg[1] / resolution + i) - begin],
-                                         [int(seg[0] / resolution - i) - begin, int(seg[1] / resolution - i) - begin],
-                                         color=colors[l], linewidth=7, label=str(l))
-                                plt.plot([int(seg[0] / resolution + i) - begin, int(seg[1] / resolution + i) - begin],
-                                         [int(seg[0] / resolution + 1 - i) - begin, int(seg[0] / resolution + 1 - i) - begin],
-                                         color=colors[l], linewidth=7, label=str(l))
-                                plt.plot([int(seg[1] / resolution - 1 + i) - begin, int(seg[1] / resolution - 1 + i) - begin],
-                                         [int(seg[0] / resolution - i) - begin, int(seg[1] / resolution - i) - begin],
-                                         color=colors[l], linewidth=7, label=str(l))
-                    else:
-                        if seg[0] < end and seg[1] > begin:
-                            plt.plot([seg[0] - begin, seg[1] - begin], [seg[0] - begin, seg[0] - begin],
-                                     color=colors[l], linewidth=7, label=str(l))
-                            plt.plot([seg[1] - begin, seg[1] - begin], [seg[0] - begin, seg[1] - begin],
-                                     color=colors[l], linewidth=7, label=str(l))
+                mask, lines = _tads_lines(segments, resolution, begin, end, is_insulation)
+                labels = df_tmp[clusters_name].values[mask]
+                for l in pd.unique(labels):
+                    ax.add_collection(LineCollection(lines[labels == l].reshape(-1, 2, 2), colors=[colors[l]],
+                                                     linewidths=7, label=str(l)))
+            elif is_insulation and consensus and sum(stage_mask) == len(stage_mask):
+                stages_tmp = df_tmp['stage'].values
+                shifts = np.array([lof_dict[x] for x in stages_tmp])
+                mask, lines = _tads_lines(segments, resolution, begin, end, is_insulation, shifts=shifts)
+                labels = stages_tmp[mask]
+                for stg in pd.unique(labels):
+                    ax.add_collection(LineCollection(lines[labels == stg].reshape(-1, 2, 2),
+                                                     colors=[colors_consensus[dict_of_stages[stg]]], linewidths=7,
+                                                     label=stg))
             else:
-                for ii, seg in enumerate(segments):
-                    if is_insulation:
-                        if int(seg[0] / resolution) < end and int(seg[1] / resolution) > begin:
-                            for i in range(1):
-                                if not consensus:
-                                    plt.plot(
-                                        [int(seg[0] / resolution + i) - begin, int(seg[1] / resolution + i) - begin],
-                                        [int(seg[0] / resolution - i) - begin, int(seg[0] / resolution - i) - begin],
-                                        color='blue', linewidth=7)
-                                    plt.plot(
-                                        [int(seg[1] / resolution + i) - begin, int(seg[1] / resolution + i) - begin],
-                                        [int(seg[0] / resolution - i) - begin, int(seg[1] / resolution - i) - begin],
-                                        color='blue', linewidth=7)
-                                    plt.plot(
-                                        [int(seg[0] / resolution + i) - begin, int(seg[1] / resolution + i) - begin],
-                                        [int(seg[0] / resolution + 1 - i) - begin,
-                                         int(seg[0] / resolution + 1 - i) - begin],
-                                        color='blue', linewidth=7)
-                                    plt.plot([int(seg[1] / resolution - 1 + i) - begin,
-                                              int(seg[1] / resolution - 1 + i) - begin],
-                                             [int(seg[0] / resolution - i) - begin,
-                                              int(seg[1] / resolution - i) - begin],
-                                             color='blue', linewidth=7)
-                                elif consensus and sum(stage_mask) == len(stage_mask):
-                                    if not any([stg.startswith('3-4h') for stg in list_of_stages]):
-                                        lof_sorted = sorted(list_of_stages, reverse=True)
-                                    else:
-                                        lof_sorted = sorted(list_of_stages, reverse=True)
-                                        lof_sorted = [lof_sorted[-1]] + lof_sorted[:-1]
-                                    lof_dict = {stage_lof: i_d for i_d, stage_lof in enumerate(lof_sorted)}
-                                    plt.plot(
-                                        [int(seg[0] / resolution + lof_dict[boundaries_stages[ii]]) - begin, int(seg[1] / resolution + lof_dict[boundaries_stages[ii]]) - begin],
-                                        [int(seg[0] / resolution - lof_dict[boundaries_stages[ii]]) - begin, int(seg[0] / resolution - lof_dict[boundaries_stages[ii]]) - begin],
-                                        color=colors_consensus[dict_of_stages[boundaries_stages[ii]]], linewidth=7, label=boundaries_stages[ii])
-                                    plt.plot(
-                                        [int(seg[1] / resolution + lof_dict[boundaries_stages[ii]]) - begin, int(seg[1] / resolution + lof_dict[boundaries_stages[ii]]) - begin],
-                                        [int(seg[0] / resolution - lof_dict[boundaries_stages[ii]]) - begin, int(seg[1] / resolution - lof_dict[boundaries_stages[ii]]) - begin],
-                                        color=colors_consensus[dict_of_stages[boundaries_stages[ii]]], linewidth=7, label=boundaries_stages[ii])
-                                    plt.plot(
-                                        [int(seg[0] / resolution + lof_dict[boundaries_stages[ii]]) - begin, int(seg[1] / resolution + lof_dict[boundaries_stages[ii]]) - begin],
-                                        [int(seg[0] / resolution + 1 - lof_dict[boundaries_stages[ii]]) - begin,
-                                         int(seg[0] / resolution + 1 - lof_dict[boundaries_stages[ii]]) - begin],
-                                        color=colors_consensus[dict_of_stages[boundaries_stages[ii]]], linewidth=7, label=boundaries_stages[ii])
-                                    plt.plot([int(seg[1] / resolution - 1 + lof_dict[boundaries_stages[ii]]) - begin,
-                                              int(seg[1] / resolution - 1 + lof_dict[boundaries_stages[ii]]) - begin],
-                                             [int(seg[0] / resolution - lof_dict[boundaries_stages[ii]]) - begin,
-                                              int(seg[1] / resolution - lof_dict[boundaries_stages[ii]]) - begin],
-                                             color=colors_consensus[dict_of_stages[boundaries_stages[ii]]], linewidth=7, label=boundaries_stages[ii])
-                                elif consensus and sum(stage_mask) != len(stage_mask):
-                                    plt.plot(
-                                        [int(seg[0] / resolution + i) - begin, int(seg[1] / resolution + i) - begin],
-                                        [int(seg[0] / resolution - i) - begin, int(seg[0] / resolution - i) - begin],
-                                        color='blue', linewidth=7)
-                                    plt.plot(
-                                        [int(seg[1] / resolution + i) - begin, int(seg[1] / resolution + i) - begin],
-                                        [int(seg[0] / resolution - i) - begin, int(seg[1] / resolution - i) - begin],
-                                        color='blue', linewidth=7)
-                                    plt.plot(
-                                        [int(seg[0] / resolution + i) - begin, int(seg[1] / resolution + i) - begin],
-                                        [int(seg[0] / resolution + 1 - i) - begin,
-                                         int(seg[0] / resolution + 1 - i) - begin],
-                                        color='blue', linewidth=7)
-                                    plt.plot([int(seg[1] / resolution - 1 + i) - begin,
-                                              int(seg[1] / resolution - 1 + i) - begin],
-                                             [int(seg[0] / resolution - i) - begin,
-                                              int(seg[1] / resolution - i) - begin],
-                                             color='blue', linewidth=7)
-                    else:
-                        if seg[0] < end and seg[1] > begin:
-                            plt.plot([seg[0] - begin, seg[1] - begin], [seg[0] - begin, seg[0] - begin], color='blue', linewidth=7)
-                            plt.plot([seg[1] - begin, seg[1] - begin], [seg[0] - begin, seg[1] - begin], color='blue', linewidth=7)
+                _, lines = _tads_lines(segments, resolution, begin, end, is_insulation)
+                ax.add_collection(LineCollection(lines.reshape(-1, 2, 2), colors='blue', linewidths=7))
 
             if clusters:
-                handles, labels = plt.gca().get_legend_handles_labels()
+                handles, labels = ax.get_legend_handles_labels()
                 by_label = OrderedDict(zip(labels, handles))
-                lgd = plt.legend(by_label.values(), by_label.keys(), title='Clusters:', loc='upper right', prop={'size': 25})
+                lgd = ax.legend(by_label.values(), by_label.keys(), title='Clusters:', loc='upper right', prop={'size': 25})
                 lgd.get_title().set_fontsize('25')
 
             elif consensus and sum(stage_mask) == len(stage_mask):
-                handles, labels = plt.gca().get_legend_handles_labels()
+                handles, labels = ax.get_legend_handles_labels()
                 by_label = OrderedDict(zip(labels, handles))
-                lgd = plt.legend(by_label.values(), by_label.keys(), title='Stages:', loc='upper right', prop={'size': 25})
+                lgd = ax.legend(by_label.values(), by_label.keys(), title='Stages:', loc='upper right', prop={'size': 25})
                 lgd.get_title().set_fontsize('25')
-            plt.title(ch + '; ' + exp + '; ' + str(begin) + ':' + str(end) + '; ' + 'clustering: ' + str(clusters))
-            plt.draw()
-            plt.savefig(join(data_path, ch + '_' + exp + '_' + str(begin) + '_' + str(end) + '_' + 'clustering_' + str(clusters) + '.png'))
+            ax.set_title(ch + '; ' + exp + '; ' + str(begin) + ':' + str(end) + '; ' + 'clustering: ' + str(clusters))
+            fig.savefig(join(data_path, ch + '_' + exp + '_' + str(begin) + '_' + str(end) + '_' + 'clustering_' + str(clusters) + '.png'))
 
 
 def compute_d_z_scores(seg_path, datasets, chrms):
@@ -942,25 +1028,20 @@ def compute_d_z_scores(seg_path, datasets, chrms):
     logging.info("COMPUTE_D_Z_SCORES| Start computing D-scores...")
     in_time = time.time()
     df = pd.read_csv(seg_path, sep='\t', index_col=0)
-    df_res = pd.DataFrame()
+    koi = ["D_{}".format(exp) for exp in datasets]
+    df_by_ch = dict(list(df.groupby('ch')))
+    df_parts = []
     for ch in chrms:
-        df_tmp = df.query("ch=='{}'".format(ch))
+        df_tmp = df_by_ch.get(ch, df.iloc[:0])
         if df_tmp.shape[0] == 0: continue
         segments = df_tmp[['bgn', 'end']].values
-        for exp in list(datasets.keys()):
-            mtx_cor = datasets[exp][ch]
-            np.fill_diagonal(mtx_cor, 0)
-            Ds = get_d_score(mtx_cor, segments)
-            df_tmp.loc[:, "D_{}".format(exp)] = Ds
+        Ds = get_d_score_batch([datasets[exp][ch] for exp in datasets], segments)
+        df_tmp = df_tmp.assign(**{x: Ds[i] for i, x in enumerate(koi)})
 
-        koi = ["D_{}".format(exp) for exp in list(datasets.keys())]
-        for x in koi:
-            df_tmp.loc[:, 'z{}'.format(x)] = 0
-
-        df_tmp[['z{}'.format(x) for x in koi]] = np.array([x for x in df_tmp.loc[:, koi].apply(scipy.stats.zscore, axis=1).values])
-        df_tmp.reset_index(drop=True)
-        df_res = df_res.append(df_tmp, ignore_index=True)
-        df_res = df_res.dropna(axis=0).reset_index(drop=True)
+        z_scores = scipy.stats.zscore(df_tmp[koi].values, axis=1)
+        df_tmp = df_tmp.assign(**{'z{}'.format(x): z_scores[:, i] for i, x in enumerate(koi)})
+        df_parts.append(df_tmp)
+    df_res = pd.concat(df_parts, ignore_index=True).dropna(axis=0).reset_index(drop=True) if df_parts else pd.DataFrame()
     time_elapsed = time.time() - in_time
     logging.info(
         "COMPUTE_D_Z_SCORES| Complete computing D-scores in {:.0f}m {:.0f}s".format(time_elapsed // 60, time_elapsed % 60))
@@ -980,25 +1061,26 @@ def compute_ins_z_scores(seg_path, cool_sets, stages, chrms, ignore_diags=2):
     logging.info("COMPUTE_INS_Z_SCORES| Start computing insulation scores...")
     in_time = time.time()
     segmentation = pd.read_csv(seg_path, sep='\t', index_col=0)
+    # chromosomes with the same optimal window are processed by a single cooltools call
+    opt_windows = segmentation.drop_duplicates('ch').set_index('ch')['window']
+    chrms_by_window = OrderedDict()
+    for ch in chrms:
+        chrms_by_window.setdefault(int(opt_windows[ch]), []).append(ch)
+
     for stage in stages:
-        ins_scores = pd.DataFrame(
-            columns=['chrom', 'start', 'end', 'is_bad_bin', 'log2_insulation_score', 'n_valid_pixels'])
-        for ch in chrms:
-            opt_window_ch = segmentation.query("ch=='{}'".format(ch))['window'].iloc[0]
-            sub_df = cooltools.insulation.calculate_insulation_score(cool_sets[stage], int(opt_window_ch),
-                                                                     ignore_diags=ignore_diags, chromosomes=[ch])
-            sub_df.rename(columns={'log2_insulation_score_{}'.format(int(opt_window_ch)): 'log2_insulation_score',
-                                   'n_valid_pixels_{}'.format(int(opt_window_ch)): 'n_valid_pixels'}, inplace=True)
-            ins_scores = pd.concat([ins_scores, sub_df])
-        ins_scores.reset_index(drop=True, inplace=True)
-        segmentation['ins_score_{}'.format(stage)] = list(map(lambda x, y, z: ins_scores[
-            (ins_scores['start'] == x) & (ins_scores['end'] == y) & (ins_scores['chrom'] == z)][
-            'log2_insulation_score'].iloc[-1], segmentation['bgn'], segmentation['end'], segmentation['ch']))
-        segmentation.loc[:, 'z_ins_score_{}'.format(stage)] = 0
-    segmentation[['z_ins_score_{}'.format(x) for x in stages]] = np.array([x for x in segmentation.loc[:,
-                                                                                      ['ins_score_{}'.format(x) for x in
-                                                                                       stages]].apply(
-        scipy.stats.zscore, axis=1).values])
+        ins_parts = []
+        for opt_window, chrms_window in chrms_by_window.items():
+            sub_df = cooltools.insulation.calculate_insulation_score(cool_sets[stage], opt_window,
+                                                                     ignore_diags=ignore_diags, chromosomes=chrms_window)
+            sub_df.rename(columns={'log2_insulation_score_{}'.format(opt_window): 'log2_insulation_score',
+                                   'n_valid_pixels_{}'.format(opt_window): 'n_valid_pixels'}, inplace=True)
+            ins_parts.append(sub_df)
+        ins_scores = pd.concat(ins_parts, ignore_index=True).set_index(['chrom', 'start', 'end'])['log2_insulation_score']
+        ins_scores = ins_scores[~ins_scores.index.duplicated(keep='last')]
+        segmentation['ins_score_{}'.format(stage)] = ins_scores.reindex(
+            pd.MultiIndex.from_arrays([segmentation['ch'], segmentation['bgn'], segmentation['end']])).values
+    z_scores = scipy.stats.zscore(segmentation[['ins_score_{}'.format(x) for x in stages]].values, axis=1)
+    segmentation = segmentation.assign(**{'z_ins_score_{}'.format(x): z_scores[:, i] for i, x in enumerate(stages)})
     segmentation = segmentation.dropna(axis=0, subset=['z_ins_score_{}'.format(x) for x in stages]).reset_index(drop=True)
     time_elapsed = time.time() - in_time
     logging.info(
@@ -1007,6 +1089,16 @@ def compute_ins_z_scores(seg_path, cool_sets, stages, chrms, ignore_diags=2):
     return segmentation
 
 
+def _dynamics_lines(values):
+    """
+    Function to build lines of TADs dynamics in space of stages.
+    :param values: 2D numpy array of scores where rows correspond to TADs and columns correspond to stages.
+    :return: 3D numpy array of lines with shape (number of TADs, number of stages, 2) to be passed to LineCollection.
+    """
+    x = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+    return np.stack([x, values], axis=-1)
+
+
 def viz_stats(data_path, stages, df, is_insulation):
     """
     Function to vizualize some statistics based on D-z-scores.
@@ -1018,13 +1110,18 @@ def viz_stats(data_path, stages, df, is_insulation):
     """
     col_temp = "ins_score_{}" if is_insulation else "D_{}"
     z_col_temp = "z_ins_score_{}" if is_insulation else "zD_{}"
+    z_cols = [z_col_temp.format(x) for x in stages]
+    Z = df[z_cols].values.astype(np.float32)
     lbl = 'D-score'; z_lbl = 'zD-score'
     plt.figure(figsize=[10, 7])
+    bins = np.arange(-2, 2, 0.05)
+    bin_centers = 0.5 * (bins[:-1] + bins[1:])
     v = df[[col_temp.format(x) for x in stages]].values
-    sns.distplot(v[np.isfinite(v)], label=lbl, bins=np.arange(-2, 2, 0.05))
+    density, _ = np.histogram(v[np.isfinite(v)], bins=bins, density=True)
+    plt.plot(bin_centers, density, label=lbl)
 
-    v = df[[z_col_temp.format(x) for x in stages]].values
-    sns.distplot(v[np.isfinite(v)], label=z_lbl, bins=np.arange(-2, 2, 0.05))
+    density, _ = np.histogram(Z[np.isfinite(Z)], bins=bins, density=True)
+    plt.plot(bin_centers, density, label=z_lbl)
 
     plt.legend()
 
@@ -1032,34 +1129,52 @@ def viz_stats(data_path, stages, df, is_insulation):
     plt.draw()
     plt.savefig(join(data_path, 'scores_density.png'))
 
-    sns.clustermap(df.loc[:, [z_col_temp.format(x) for x in stages]].corr(), cmap='RdBu_r', center=0).savefig(join(data_path, 'stages_correlation.png'))
+    sns.clustermap(df[z_cols].corr(), cmap='RdBu_r', center=0).savefig(join(data_path, 'stages_correlation.png'))
 
-    colors = sns.color_palette('Set1', len([z_col_temp.format(x) for x in stages]))
+    colors = sns.color_palette('Set1', len(z_cols))
 
-    fig, axes = plt.subplots(len([z_col_temp.format(x) for x in stages]), 1, sharey=True, figsize=[5, 15])
+    fig, axes = plt.subplots(len(z_cols), 1, sharey=True, figsize=[5, 15])
 
-    v_pres = {}
-    for i, r in df.iterrows():
-        v = np.argmax(r[[z_col_temp.format(x) for x in stages]].values)
-        color = colors[v]
-        if not v in v_pres.keys():
-            v_pres[v] = 0
-            axes[v].plot(r[[z_col_temp.format(x) for x in stages]], label=v, color=color, alpha=0.5)
-        else:
-            axes[v].plot(r[[z_col_temp.format(x) for x in stages]].values, color=color, alpha=0.2)
-        v_pres[v] += 1
-
-    for v in v_pres:
+    lines = _dynamics_lines(Z)
+    top_stages = np.argmax(Z, axis=1)
+    for v, idx in pd.Series(top_stages).groupby(top_stages).indices.items():
+        lines_v = lines[idx]
+        axes[v].add_collection(LineCollection(lines_v[:1], colors=[colors[v]], alpha=0.5))
+        axes[v].add_collection(LineCollection(lines_v[1:], colors=[colors[v]], alpha=0.2))
+        axes[v].autoscale_view()
+        axes[v].set_xticks(range(len(z_cols)))
         axes[v].set_xticklabels([])
-        axes[v].set_title("{}; {} TADs".format([z_col_temp.format(x) for x in stages][v], v_pres[v]))
+        axes[v].set_title("{}; {} TADs".format(z_cols[v], len(lines_v)))
 
-    axes[-1].set_xticklabels([z_col_temp.format(x) for x in stages], rotation=90)
+    axes[-1].set_xticks(range(len(z_cols)))
+    axes[-1].set_xticklabels(z_cols, rotation=90)
 
     plt.draw()
     plt.savefig(join(data_path, 'tads_stages_dynamics.png'))
 
 
-def perform_clustering(df, seg_path, data_path, mode, method, n_clusters, stages, rs, damping, max_iter, convergence_iter, is_insulation):
+def _fit_clustering_range(sample_idx, method, n_cluster, rs, affinity=None, linkage_tree=None):
+    """
+    Function to fit hierarchical or spectral clustering with a certain number of clusters.
+    It is a worker of perform_clustering function in range mode.
+    :param sample_idx: indices of TADs to return labels for.
+    :param method: clustering method ('hierarchical' or 'spectral').
+    :param n_cluster: number of clusters.
+    :param rs: random state for clustering.
+    :param affinity: precomputed affinity matrix of TADs for spectral clustering.
+    :param linkage_tree: precomputed ward linkage of TADs for hierarchical clustering.
+    :return: cluster labels of sampled TADs.
+    """
+    if method == 'hierarchical':
+        cluster_labels = fcluster(linkage_tree, t=n_cluster, criterion='maxclust')[sample_idx] - 1
+    else:
+        cluster_labels = SpectralClustering(n_clusters=n_cluster, random_state=rs,
+                                            affinity='precomputed').fit(affinity).labels_[sample_idx]
+    return cluster_labels
+
+
+def perform_clustering(df, seg_path, data_path, mode, method, n_clusters, stages, rs, damping, max_iter, convergence_iter, is_insulation,
+                       sample_size=10000, n_jobs=-1):
     """
     Function to perform clustering under the given (optimal) segmentation.
     :param df: adjusted dataframe with segmentation and calculated D-z-scores.
@@ -1077,15 +1192,21 @@ def perform_clustering(df, seg_path, data_path, mode, method, n_clusters, stages
     :param max_iter: max_inter parameter for affinity propagation clustering.
     :param convergence_iter: convergence_iter parameter for affinity propagation clustering.
     :param: is_insulation: True in case of segmentation based on insulation score.
+    :param sample_size: maximum number of TADs to compute silhouettes on in case of mode='range'. Larger datasets
+    are randomly subsampled, because silhouette computation is quadratic in the number of TADs.
+    :param n_jobs: number of processes to fit clusterings for the range of number of clusters in parallel
+    (-1 -- all cores). Only for mode='range'.
     :return: adjusted dataframe with clustering (add a column 'cluster_METHOD' with cluster's labels.
     """
     col_temp = "z_ins_score_{}" if is_insulation else "zD_{}"
+    X = df[[col_temp.format(x) for x in stages]].values.astype(np.float32)
     if mode == 'range':
         if method == 'kmeans':
             sum_of_squared_distances = []
             for k in range(1, n_clusters + 1):
-                km = KMeans(n_clusters=k, random_state=rs)
-                km = km.fit(df[[col_temp.format(x) for x in stages]])
+                # single initialization is enough for the elbow curve on low-dimensional (number of stages) data
+                km = KMeans(n_clusters=k, n_init=1, algorithm='elkan', random_state=rs)
+                km = km.fit(X)
                 sum_of_squared_distances.append(km.inertia_)
             plt.figure(figsize=[10, 7])
             plt.plot(np.arange(1, n_clusters + 1), sum_of_squared_distances, 'bx-')
@@ -1099,40 +1220,49 @@ def perform_clustering(df, seg_path, data_path, mode, method, n_clusters, stages
             return
         elif method == 'hierarchical' or method == 'spectral':
             # fig, ax1 = plt.subplots(n_clusters, 1, sharey=True, figsize=[15, int(15 * n_clusters / 4)])
-            for n_cluster in range(2, n_clusters + 1):
-                fig, ax1 = plt.subplots(1, 1)
-                fig.set_size_inches(18, 7)
+            sample_size = min(df.shape[0], sample_size)
+            sample_idx = np.sort(np.random.RandomState(rs).choice(df.shape[0], sample_size, replace=False))
+            n_cluster_range = list(range(2, n_clusters + 1))
+            # affinity depends on TADs only, so it is computed once for the whole range (rbf with sklearn's default gamma)
+            affinity = rbf_kernel(X, gamma=1.0) if method == 'spectral' else None
+            # the same holds for ward tree: it is built once and then cut at each number of clusters
+            linkage_tree = linkage(X, method='ward') if method == 'hierarchical' else None
+            # clusterings are fitted in parallel, plots are drawn sequentially in the main process
+            labelings = Parallel(n_jobs=n_jobs, backend='loky')(
+                delayed(_fit_clustering_range)(sample_idx, method, n_cluster, rs, affinity, linkage_tree) for n_cluster in n_cluster_range)
+            # silhouettes of all clusterings share a single pass over distances between sampled TADs
+            silhouettes = get_silhouette_samples_batch(X[sample_idx], labelings)
+            # one figure is reused (cleared) for each number of clusters
+            fig, ax1 = plt.subplots(1, 1)
+            fig.set_size_inches(18, 7)
+            fig.suptitle(("Silhouette analysis for {} clustering on sample data with n_clusters = {}".format(method, n_clusters)),
+                         fontsize=14, fontweight='bold')
+            for n_cluster, cluster_labels, sample_silhouette_values in zip(n_cluster_range, labelings, silhouettes):
+                silhouette_avg = np.mean(sample_silhouette_values)
+                ax1.cla()
                 ax1.set_xlim([-0.1, 1])
-                ax1.set_ylim([0, df.shape[0] + (n_cluster + 1) * 10])
-
-                ac = AgglomerativeClustering(n_clusters=n_cluster) if method == 'hierarchical' else SpectralClustering(n_clusters=n_cluster, random_state=rs)
-                ac = ac.fit(df[[col_temp.format(x) for x in stages]])
-                cluster_labels = ac.labels_
-
-                silhouette_avg = silhouette_score(df[[col_temp.format(x) for x in stages]], cluster_labels)
+                ax1.set_ylim([0, sample_size + (n_cluster + 1) * 10])
 
                 logging.info("PERFORM_CLUSTERING| For n_clusters = {} the average silhouette_score is {}".format(n_cluster, silhouette_avg))
 
-                sample_silhouette_values = silhouette_samples(df[[col_temp.format(x) for x in stages]], cluster_labels)
-
+                # silhouette values sorted within each cluster, clusters go one after another
+                sorted_values = sample_silhouette_values[np.lexsort((sample_silhouette_values, cluster_labels))]
+                sizes = np.bincount(cluster_labels, minlength=n_cluster)
+                starts = np.concatenate([[0], np.cumsum(sizes)])
+                polygons, colors = [], []
                 y_lower = 10
                 for i in range(n_cluster):
-                    ith_cluster_silhouette_values = \
-                        sample_silhouette_values[cluster_labels == i]
-
-                    ith_cluster_silhouette_values.sort()
-
-                    size_cluster_i = ith_cluster_silhouette_values.shape[0]
-                    y_upper = y_lower + size_cluster_i
+                    y_upper = y_lower + sizes[i]
+                    if sizes[i] > 0:
+                        y = np.arange(y_lower, y_upper)
+                        polygons.append(np.concatenate([np.column_stack([sorted_values[starts[i]:starts[i + 1]], y]),
+                                                        [[0, y[-1]], [0, y[0]]]]))
+                        colors.append(cm.nipy_spectral(float(i) / n_cluster))
 
-                    color = cm.nipy_spectral(float(i) / n_cluster)
-                    ax1.fill_betweenx(np.arange(y_lower, y_upper),
-                                      0, ith_cluster_silhouette_values,
-                                      facecolor=color, edgecolor=color, alpha=0.7)
-
-                    ax1.text(-0.05, y_lower + 0.5 * size_cluster_i, str(i))
+                    ax1.text(-0.05, y_lower + 0.5 * sizes[i], str(i))
 
                     y_lower = y_upper + 10
+                ax1.add_collection(PolyCollection(polygons, facecolors=colors, edgecolors=colors, alpha=0.7))
 
                 ax1.set_title("The silhouette plot for the various clusters.")
                 ax1.set_xlabel("The silhouette coefficient values")
@@ -1142,34 +1272,31 @@ def perform_clustering(df, seg_path, data_path, mode, method, n_clusters, stages
                 ax1.set_yticks([])
                 ax1.set_xticks([-0.1, 0, 0.2, 0.4, 0.6, 0.8, 1])
 
-                plt.suptitle(("Silhouette analysis for {} clustering on sample data with n_clusters = {}".format(method, n_clusters)),
-                             fontsize=14, fontweight='bold')
-
-                plt.draw()
-                plt.savefig(join(data_path, 'silhouette_{}_nk_{}.png'.format(method, n_cluster)))
+                fig.savefig(join(data_path, 'silhouette_{}_nk_{}.png'.format(method, n_cluster)))
+            plt.close(fig)
         else:
             logging.error('PERFORM_CLUSTERING| Choose correct clustering method!'.format(method))
             return
         return
     elif mode == 'certain':
         if method == 'kmeans':
-            km = KMeans(n_clusters=n_clusters, random_state=rs).fit(df[[col_temp.format(x) for x in stages]])
+            km = KMeans(n_clusters=n_clusters, random_state=rs).fit(X)
             centroids, labels_ = km.cluster_centers_, km.labels_
             df.loc[:, "cluster_kmeans"] = labels_
         elif method == 'meanshift':
-            ms = MeanShift().fit(df[[col_temp.format(x) for x in stages]])
+            ms = MeanShift().fit(X)
             centroids, labels_ = ms.cluster_centers_, ms.labels_
             df.loc[:, "cluster_meanshift"] = labels_
         elif method == 'hierarchical':
-            ac = AgglomerativeClustering(n_clusters=n_clusters).fit(df[[col_temp.format(x) for x in stages]])
+            ac = AgglomerativeClustering(n_clusters=n_clusters).fit(X)
             labels_ = ac.labels_
             df.loc[:, "cluster_hierarchical"] = labels_
         elif method == 'spectral':
-            sc = SpectralClustering(n_clusters=n_clusters, random_state=rs).fit(df[[col_temp.format(x) for x in stages]])
+            sc = SpectralClustering(n_clusters=n_clusters, random_state=rs).fit(X)
             labels_ = sc.labels_
             df.loc[:, "cluster_spectral"] = labels_
         elif method == 'affinity_propagation':
-            ap = AffinityPropagation(damping=damping, max_iter=max_iter, convergence_iter=convergence_iter).fit(df[[col_temp.format(x) for x in stages]])
+            ap = AffinityPropagation(damping=damping, max_iter=max_iter, convergence_iter=convergence_iter).fit(X)
             centroids, labels_ = ap.cluster_centers_, ap.labels_
             df.loc[:, "cluster_affinity_propagation"] = labels_
         else:
@@ -1190,6 +1317,7 @@ def viz_clusters_dynamics(df, data_path, method, stages, is_insulation):
     :return: seaborn colors palette to encode clusters with certain colors.
     """
     col_temp = "z_ins_score_{}" if is_insulation else "zD_{}"
+    cols = [col_temp.format(x) for x in stages]
     clusters_name = '_'.join(['cluster', method])
     n_clusters = len(set(df[clusters_name]))
     colors = sns.color_palette('rainbow', n_clusters)
@@ -1197,17 +1325,13 @@ def viz_clusters_dynamics(df, data_path, method, stages, is_insulation):
 
     fig, axes = plt.subplots(1, 1, sharey=True, figsize=[5, int(15 * 1 / 4)])
 
-    v_pres = {}
-    v = 0
-    for i, r in df.iterrows():
-        if not v in v_pres.keys():
-            v_pres[v] = 0
-            axes.plot(r[[col_temp.format(x) for x in stages]], label=v, color='grey', alpha=0.1)
-        else:
-            axes.plot(r[[col_temp.format(x) for x in stages]].values, color='black', alpha=0.1)
-        v_pres[v] += 1
+    lines = _dynamics_lines(df[cols].values.astype(np.float32))
+    axes.add_collection(LineCollection(lines[:1], colors='grey', alpha=0.1))
+    axes.add_collection(LineCollection(lines[1:], colors='black', alpha=0.1))
+    axes.autoscale_view()
 
-    axes.set_xticklabels([col_temp.format(x) for x in stages], rotation=90)
+    axes.set_xticks(range(len(stages)))
+    axes.set_xticklabels(cols, rotation=90)
     plt.title('All clusters. Method: {}'.format(method))
     plt.draw()
     plt.savefig(join(data_path, 'all_clusters_{}.png'.format(method)))
@@ -1215,22 +1339,20 @@ def viz_clusters_dynamics(df, data_path, method, stages, is_insulation):
     fig, axes = plt.subplots(n_clusters, 1, sharey=True, figsize=[5, int(15 * n_clusters / 4)])
 
     v_pres = {}
-    for v, (i, r) in zip(df[clusters_name], df.iterrows()):
-        color = colors[v]
-        if not v in v_pres.keys():
-            v_pres[v] = 0
-            try:
-                axes[v].plot(r[[col_temp.format(x) for x in stages]], label=v, color=color, alpha=0.1)
-            except:
-                axes.plot(r[[col_temp.format(x) for x in stages]], label=v, color=color, alpha=0.1)
-        else:
-            try:
-                axes[v].plot(r[[col_temp.format(x) for x in stages]].values, color=color, alpha=0.1)
-            except:
-                axes.plot(r[[col_temp.format(x) for x in stages]].values, color=color, alpha=0.1)
-        v_pres[v] += 1
+    cluster_labels = df[clusters_name].values
+    for v in pd.unique(cluster_labels):
+        lines_v = lines[cluster_labels == v]
+        try:
+            axes[v].add_collection(LineCollection(lines_v, colors=[colors[v]], alpha=0.1))
+            axes[v].autoscale_view()
+            axes[v].set_xticks(range(len(stages)))
+        except:
+            axes.add_collection(LineCollection(lines_v, colors=[colors[v]], alpha=0.1))
+            axes.autoscale_view()
+            axes.set_xticks(range(len(stages)))
+        v_pres[v] = len(lines_v)
 
-    centroids = [list(np.mean(df[df[clusters_name] == nk][[col_temp.format(x) for x in stages]])) for nk in range(n_clusters)]
+    centroids = df.groupby(clusters_name)[cols].mean().reindex(range(n_clusters)).values
     for v, c in enumerate(centroids):
         color = colors1[v]
         try:
@@ -1247,9 +1369,9 @@ def viz_clusters_dynamics(df, data_path, method, stages, is_insulation):
             axes.set_title("Cluster: {} N: {}".format(v, v_pres[v]))
 
     try:
-        axes[-1].set_xticklabels([col_temp.format(x) for x in stages], rotation=90)
+        axes[-1].set_xticklabels(cols, rotation=90)
     except:
-        axes.set_xticklabels([col_temp.format(x) for x in stages], rotation=90)
+        axes.set_xticklabels(cols, rotation=90)
 
     plt.draw()
     plt.savefig(join(data_path, 'clusters_detalization_{}.png'.format(method)))
@@ -1272,14 +1394,12 @@ def viz_pca(df, data_path, stages, method, is_insulation):
     n_clusters = len(set(df[clusters_name]))
 
     if len(stages) >= 3:
-        pca = PCA(n_components=3)
+        pca = PCA(n_components=3, copy=False, svd_solver='randomized')
     else:
-        pca = PCA(n_components=2)
+        pca = PCA(n_components=2, copy=False, svd_solver='randomized')
 
-    pca_result = pca.fit_transform(df[[col_temp.format(x) for x in stages]].values)
-    df_pca = df.copy()
-    df_pca['pca-one'] = pca_result[:, 0]
-    df_pca['pca-two'] = pca_result[:, 1]
+    pca_result = pca.fit_transform(np.ascontiguousarray(df[[col_temp.format(x) for x in stages]].values, dtype=np.float32))
+    df_pca = pd.DataFrame({'pca-one': pca_result[:, 0], 'pca-two': pca_result[:, 1], clusters_name: df[clusters_name].values})
     
     if len(stages) >= 3:
         df_pca['pca-three'] = pca_result[:, 2]
@@ -1331,12 +1451,17 @@ def viz_tsne(df, data_path, stages, method, perplexity, rs, is_insulation):
     clusters_name = '_'.join(['cluster', method])
     n_clusters = len(set(df[clusters_name]))
     time_start = time.time()
-    tsne = TSNE(n_components=2, perplexity=perplexity, random_state=rs)
-    tsne_results = tsne.fit_transform(df[[col_temp.format(x) for x in stages]])
+    X = df[[col_temp.format(x) for x in stages]].values.astype(np.float32)
+    if OpenTSNE is not None:
+        # FFT-accelerated multi-threaded t-SNE (FIt-SNE) if openTSNE is installed
+        tsne = OpenTSNE(n_components=2, perplexity=perplexity, random_state=rs, n_jobs=-1,
+                        negative_gradient_method='fft')
+        tsne_results = np.asarray(tsne.fit(X))
+    else:
+        tsne = TSNE(n_components=2, perplexity=perplexity, random_state=rs)
+        tsne_results = tsne.fit_transform(X)
     logging.info("VIZ_TSNE| t-SNE done! Time elapsed: {} seconds".format(time.time() - time_start))
-    df_tsne = df.copy()
-    df_tsne['tsne-2d-one'] = tsne_results[:, 0]
-    df_tsne['tsne-2d-two'] = tsne_results[:, 1]
+    df_tsne = pd.DataFrame({'tsne-2d-one': tsne_results[:, 0], 'tsne-2d-two': tsne_results[:, 1], clusters_name: df[clusters_name].values})
     plt.figure(figsize=(16, 10))
     sns.scatterplot(
         x="tsne-2d-one", y="tsne-2d-two",
@@ -1350,19 +1475,22 @@ def viz_tsne(df, data_path, stages, method, perplexity, rs, is_insulation):
     plt.savefig(join(data_path, 't-SNE_{}.png'.format(method)))
 
 
-def get_silhouette_score(df, stages, method, is_insulation):
+def get_silhouette_score(df, stages, method, is_insulation, approximate=False):
     """
     Function to get silhouette score of our clustering
     :param df: dataframe with performed clustering.
     :param stages: list of stages to investigate clusters' dynamics.
     :param method: clustering method.
     :param is_insulation: True in case of segmentation based on insulation score.
+    :param approximate: True to compute simplified (centroid-based) silhouette score which is linear in the number
+    of TADs, False to compute exact silhouette score.
     :return: silhouette score
     """
     col_temp = "z_ins_score_{}" if is_insulation else "zD_{}"
     clusters_name = '_'.join(['cluster', method])
     try:
-        return silhouette_score(df[[col_temp.format(x) for x in stages]], list(df[clusters_name]))
+        silhouette_samples = get_simplified_silhouette_samples if approximate else get_silhouette_samples
+        return np.mean(silhouette_samples(df[[col_temp.format(x) for x in stages]].values, df[clusters_name].values))
     except:
-        logginng.info("GET_SILHOUETTE_SCORE| WARNING! CAN'T CALCULATE SILHOUETTE SCORE. IT SEEMS THAT YOU HAVE ONLY 1 CLUSTER.")
+        logging.info("GET_SILHOUETTE_SCORE| WARNING! CAN'T CALCULATE SILHOUETTE SCORE. IT SEEMS THAT YOU HAVE ONLY 1 CLUSTER.")
         return 0.0
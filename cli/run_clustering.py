@@ -87,6 +87,9 @@ def run_pipeline():
                         help='True if input segmentation is based on insulation score.')
     parser.add_argument('-res', '--resolution', type=int, default=5000,
                         help='Setting resolution of Hi-C map.')
+    parser.add_argument('-nj', '--n_jobs', type=int, default=-1,
+                        help='Number of processes to fit clusterings for the range of clusters number in parallel '
+                             '(-1 -- all cores, 1 -- sequential run). Only for --mode range.')
 
     args = parser.parse_args()
 
@@ -115,6 +118,7 @@ def run_pipeline():
     VISUAL_STAGE = splitext(args.visual_stage)[0]
     IS_INSULATION = args.is_insulation
     RESOLUTION = args.resolution
+    N_JOBS = args.n_jobs
 
     for handler in logging.root.handlers[:]:
         logging.root.removeHandler(handler)
@@ -128,10 +132,10 @@ def run_pipeline():
                  "experiment_name: {}\nexperiment_path: {}\nmode: {}\nmethod: {}\nn_clusters: {}\n"
                  "stage_names: {}\nchromnames: {}\npercentile: {}\nviz_bin_count: {}\nrandom_state: {}\n"
                  "damping: {}\nmax_iter: {}\nconvergence_iter: {}\nperplexity: {}\nvisual_stage: {}\n"
-                 "is_insulation: {}\nresolution: {}".format(
+                 "is_insulation: {}\nresolution: {}\nn_jobs: {}".format(
         SEGMENTATION_PATH, INPUT_TYPE, INPUT_PATH, EXPERIMENT_NAME, EXPERIMENT_PATH, MODE, METHOD, N_CLUSTERS,
         str(STAGE_NAMES), str(CHROMNAMES), PERCENTILE, VIZ_BIN_COUNT, RS, DAMPING,
-        MAX_ITER, CONVERGENCE_ITER, PERPLEXITY, VISUAL_STAGE, IS_INSULATION, RESOLUTION))
+        MAX_ITER, CONVERGENCE_ITER, PERPLEXITY, VISUAL_STAGE, IS_INSULATION, RESOLUTION, N_JOBS))
 
     in_time = time.time()
 
@@ -143,7 +147,8 @@ def run_pipeline():
         DATA_W_D_SCORES = compute_d_z_scores(SEGMENTATION_PATH, DATASETS, CHROMNAMES)
     viz_stats(EXPERIMENT_PATH, STAGE_NAMES, DATA_W_D_SCORES, IS_INSULATION)
     FINAL_CLUSTERING = perform_clustering(DATA_W_D_SCORES, SEGMENTATION_PATH, EXPERIMENT_PATH, MODE, METHOD,
-                                          N_CLUSTERS, STAGE_NAMES, RS, DAMPING, MAX_ITER, CONVERGENCE_ITER, IS_INSULATION)
+                                          N_CLUSTERS, STAGE_NAMES, RS, DAMPING, MAX_ITER, CONVERGENCE_ITER, IS_INSULATION,
+                                          n_jobs=N_JOBS)
     if MODE == 'certain':
         colors = viz_clusters_dynamics(FINAL_CLUSTERING, EXPERIMENT_PATH, METHOD, STAGE_NAMES, IS_INSULATION)
         viz_pca(FINAL_CLUSTERING, EXPERIMENT_PATH, STAGE_NAMES, METHOD, IS_INSULATION)
@@ -94,6 +94,14 @@ def run_pipeline():
                         help='Total length of subset of boundaries to merge. In case of merge_boundaries==True')
     parser.add_argument('-nstm', '--num_stages_to_merge', type=int, default=3,
                         help='Number of stages to merge into consensus one. In case of merge_boundaries==True')
+    parser.add_argument('-nj', '--n_jobs', type=int, default=-1,
+                        help='Number of processes to search optimal segmentation for chromosomes in parallel '
+                             '(-1 -- all cores, 1 -- sequential run with detailed logs of each chromosome)')
+    parser.add_argument('-sp', '--sparse', type=bool, default=False,
+                        help='If True -- contact matrices are stored as sparse matrices (memory scales with the number '
+                             'of non-zero pixels). Only Hi-C visualization and D-scores work without densifying: '
+                             'segmentation still densifies one chromosome at a time into float64 matrix; '
+                             'if False -- contact matrices are stored as dense float32 matrices')
 
     args = parser.parse_args()
 
@@ -124,6 +132,8 @@ def run_pipeline():
     NOISE_SHIFT = args.noise_shift
     LOC_SIZE = args.loc_size
     NUM_STAGES_TO_MERGE = args.num_stages_to_merge
+    N_JOBS = args.n_jobs
+    SPARSE = args.sparse
 
     if METHOD == 'insulation' and len(np.arange(GRID[0], GRID[1], GRID[2])) > 2 and \
             len(np.arange(GRID[0], GRID[1], GRID[2])) < 10:
@@ -161,20 +171,22 @@ def run_pipeline():
                  "resolution: {}\nchromnames: {}\nmethod: {}\ngrid: {}\n"
                  "expected_mean_tad: {}\nmax_intertad: {}\nmax_tad_size: {}\npercentile: {}\nviz_bin_count: {}\n"
                  "window_spotlight: {}\nviz_tad_stage: {}\nnoise_shift: {}\nloc_size: {}\n"
-                 "num_stages_to_merge: {}".format(INPUT_TYPE, INPUT_PATH,
+                 "num_stages_to_merge: {}\nn_jobs: {}\nsparse: {}".format(INPUT_TYPE, INPUT_PATH,
                                             EXPERIMENT_NAME, EXPERIMENT_PATH, EPSILON, STAGE_NAME, FILTRATION,
                                                   str(THRESHOLDS_DATA), str(THRESHOLDS_GRID_DATA), CONSENSUS,
                                             MERGE_BOUNDARIES, RESOLUTION, str(CHROMNAMES), METHOD, str(GRID),
                                             EXPECTED_MEAN_TAD, MAX_INTERTAD, MAX_TAD_SIZE, PERCENTILE, VIZ_BIN_COUNT,
-                                            WINDOW_SPOTLIGHT, VIZ_TAD_STAGE, NOISE_SHIFT, LOC_SIZE, NUM_STAGES_TO_MERGE))
+                                            WINDOW_SPOTLIGHT, VIZ_TAD_STAGE, NOISE_SHIFT, LOC_SIZE, NUM_STAGES_TO_MERGE,
+                                            N_JOBS, SPARSE))
 
     in_time = time.time()
 
     COOLFILES_PATH = download_files(INPUT_TYPE, INPUT_PATH)
     if not CONSENSUS:
-        DATASETS, COOL_SETS = load_cool_files(COOLFILES_PATH, CHROMNAMES, RESOLUTION, [STAGE_NAME])
+        DATASETS, COOL_SETS = load_cool_files(COOLFILES_PATH, CHROMNAMES, RESOLUTION, [STAGE_NAME], sparse=SPARSE)
     else:
-        DATASETS, COOL_SETS = load_cool_files(COOLFILES_PATH, CHROMNAMES, RESOLUTION, [x.strip() for x in STAGE_NAME.split(',')])
+        DATASETS, COOL_SETS = load_cool_files(COOLFILES_PATH, CHROMNAMES, RESOLUTION, [x.strip() for x in STAGE_NAME.split(',')],
+                                              sparse=SPARSE)
     if METHOD == 'insulation':
         if not CONSENSUS:
             df, df_conc, stats, opws = search_opt_window(DATASETS, COOL_SETS, EXPERIMENT_PATH,
@@ -184,7 +196,7 @@ def run_pipeline():
                                                          percentile=PERCENTILE, eps=EPSILON,
                                                          window_eps=WINDOW_SPOTLIGHT, k=NOISE_SHIFT,
                                                          filtration=FILTRATION, bs_thresholds=THRESHOLDS_DATA,
-                                                         bs_thresholds_grid=THRESHOLDS_GRID_DATA)
+                                                         bs_thresholds_grid=THRESHOLDS_GRID_DATA, n_jobs=N_JOBS)
         else:
             df, df_conc, stats, opws = run_consensus(DATASETS, COOL_SETS, EXPERIMENT_PATH,
                                                          grid=np.arange(GRID[0], GRID[1], GRID[2]) * RESOLUTION, mis=MAX_INTERTAD,
@@ -194,7 +206,7 @@ def run_pipeline():
                                                      merge_boundaries=MERGE_BOUNDARIES, k=NOISE_SHIFT,
                                                      loc_size=LOC_SIZE, N=NUM_STAGES_TO_MERGE, filtration=FILTRATION,
                                                      bs_thresholds=THRESHOLDS_DATA,
-                                                     bs_thresholds_grid=THRESHOLDS_GRID_DATA)
+                                                     bs_thresholds_grid=THRESHOLDS_GRID_DATA, n_jobs=N_JOBS)
         if not CONSENSUS:
             viz_opt_curves(stats, METHOD, CHROMNAMES, EXPECTED_MEAN_TAD / RESOLUTION, int(EXPECTED_MEAN_TAD / 1000),
                            EXPERIMENT_PATH, df_conc, RESOLUTION, stage=STAGE_NAME)
@@ -208,7 +220,8 @@ def run_pipeline():
         opgs, df, df_conc = search_opt_gamma(DATASETS, EXPERIMENT_PATH, method=METHOD,
                                              grid=np.arange(GRID[0], GRID[1], GRID[2]), mis=MAX_INTERTAD, mts=MAX_TAD_SIZE,
                                              start_step=GRID[2], chrms=CHROMNAMES, eps=EPSILON, expected=EXPECTED_MEAN_TAD,
-                                             exp=STAGE_NAME, resolution=RESOLUTION, percentile=PERCENTILE)
+                                             exp=STAGE_NAME, resolution=RESOLUTION, percentile=PERCENTILE,
+                                             n_jobs=N_JOBS)
         viz_opt_curves(df, METHOD, CHROMNAMES, EXPECTED_MEAN_TAD / RESOLUTION, int(EXPECTED_MEAN_TAD / 1000),
                        EXPERIMENT_PATH, df_conc, RESOLUTION, stage=STAGE_NAME)
         viz_tads(EXPERIMENT_PATH, df_conc, DATASETS, CHROMNAMES, VIZ_TAD_STAGE, RESOLUTION, method=None,
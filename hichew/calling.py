@@ -4,6 +4,7 @@ import operator
 import os
 import sys
 import warnings
+from collections import deque
 
 import numpy as np
 import pandas as pd
@@ -82,21 +83,23 @@ def boundaries(matrices, coolers, label='3-4h', expected_tad_size=60000, grid=No
 
         all_bins_cnt = good_bins.shape[0]
         good_bins_cnt = good_bins[good_bins == True].shape[0]
-        tads_expected_cnt = good_bins_cnt // (expected_tad_size / resolution)
+        expected_bins = expected_tad_size / resolution
+        tads_expected_cnt = good_bins_cnt // expected_bins
 
         logging.info("CALL|BOUNDARIES| For chromosome {} with {} bins we have {} good bins and expected count of "
                      "TADs (according to expected TAD size) of {}".format(ch, all_bins_cnt, good_bins_cnt, tads_expected_cnt))
         logging.info("CALL|BOUNDARIES| Run TAD boundaries search using windows grid for chromosome {}...".format(ch))
 
-        df_bsc = pd.DataFrame(
-            columns=['bgn', 'end', 'bs_threshold', 'window', 'ch', 'insulation_score', 'boundary_strength'])
+        df_bsc_parts = {x: [] for x in bs_grid}  # key: bs_threshold, value: segmentations for each window
         opt_windows_bsc = {}  # key: bs_threshold, value: opt window
+        boundaries_cache = {}  # boundaries for each window are shared between all boundary strength thresholds
         stats_bsc = {x: {} for x in bs_grid}  # key: bs_threshold, value: stats for each window
 
         # loop for boundary strength param
         for bsg in bs_grid:
             logging.info("CALL|BOUNDARIES| Run TAD boundaries search for boundary strength threshold {}...".format(bsg))
-            boundaries_coords_0, boundaries_0 = utils.produce_boundaries_segmentation(coolers[label], grid[0], ch, min_dist_bad_bin, bsg=bsg)
+            boundaries_coords_0, boundaries_0 = utils.produce_boundaries_segmentation(coolers[label], grid[0], ch, min_dist_bad_bin,
+                                                                                      bsg=bsg, cache=boundaries_cache)
             mean_tad_size_prev, sum_cov_prev, mean_ins_prev, mean_bsc_prev, full_ins_prev, full_bsc_prev = \
                 utils.calc_mean_tad_size(boundaries_0, filters, ch, max_intertad, max_tad, grid[0], resolution)
 
@@ -112,15 +115,10 @@ def boundaries(matrices, coolers, label='3-4h', expected_tad_size=60000, grid=No
 
             stats_bsc[bsg][grid[0]] = (mean_tad_size_prev, cov_prev, bound_count_prev, ins_prev, bsc_prev)
 
-            df_tmp = pd.DataFrame(columns=['bgn', 'end', 'bs_threshold', 'window', 'ch', 'insulation_score',
-                                           'boundary_strength'], index=np.arange(len(boundaries_coords_0)))
-            df_tmp.loc[:, ['bgn', 'end']] = boundaries_coords_0
-            df_tmp['bs_threshold'] = bsg
-            df_tmp['window'] = grid[0]
-            df_tmp['ch'] = ch
-            df_tmp.loc[:, 'insulation_score'] = f_ins_prev
-            df_tmp.loc[:, 'boundary_strength'] = f_bsc_prev
-            df_bsc = pd.concat([df_bsc, df_tmp])
+            df_tmp = pd.DataFrame({'bgn': boundaries_coords_0[:, 0], 'end': boundaries_coords_0[:, 1], 'bs_threshold': bsg,
+                                   'window': grid[0], 'ch': ch, 'insulation_score': f_ins_prev,
+                                   'boundary_strength': f_bsc_prev})
+            df_bsc_parts[bsg].append(df_tmp)
 
             local_optimas = {}
             mean_tad_sizes = []
@@ -131,14 +129,15 @@ def boundaries(matrices, coolers, label='3-4h', expected_tad_size=60000, grid=No
             ins.append(ins_prev)
             bsc = []
             bsc.append(bsc_prev)
-            bounds_cnt = []
+            bounds_cnt = deque(maxlen=window_eps)  # last window_eps boundaries counts
             bounds_cnt.append(bound_count_prev)
 
             is_exp_tad_cnt_reached = False
             is_exp_tad_size_reached = False
 
             for window in grid[1:]:
-                boundaries_coords, boundaries = utils.produce_boundaries_segmentation(coolers[label], window, ch, min_dist_bad_bin, bsg=bsg)
+                boundaries_coords, boundaries = utils.produce_boundaries_segmentation(coolers[label], window, ch, min_dist_bad_bin,
+                                                                                      bsg=bsg, cache=boundaries_cache)
                 mean_tad_size, sum_cov, mean_ins, mean_bsc, full_ins, full_bsc = utils.calc_mean_tad_size(boundaries, filters,
                                                                                                     ch, max_intertad, max_tad,
                                                                                                     window, resolution)
@@ -153,19 +152,14 @@ def boundaries(matrices, coolers, label='3-4h', expected_tad_size=60000, grid=No
 
                 stats_bsc[bsg][window] = (mean_tad_size, cov, bound_count, mean_ins, mean_bsc)
 
-                df_tmp = pd.DataFrame(columns=['bgn', 'end', 'bs_threshold', 'window', 'ch', 'insulation_score',
-                                               'boundary_strength'], index=np.arange(len(boundaries_coords)))
-                df_tmp.loc[:, ['bgn', 'end']] = boundaries_coords
-                df_tmp['window'] = window
-                df_tmp['bs_threshold'] = bsg
-                df_tmp['ch'] = ch
-                df_tmp.loc[:, 'insulation_score'] = full_ins
-                df_tmp.loc[:, 'boundary_strength'] = full_bsc
-                df_bsc = pd.concat([df_bsc, df_tmp])
-
-                if (mean_tad_size - expected_tad_size / resolution) * (mean_tad_size_prev - expected_tad_size / resolution) <= 0:
+                df_tmp = pd.DataFrame({'bgn': boundaries_coords[:, 0], 'end': boundaries_coords[:, 1], 'bs_threshold': bsg,
+                                       'window': window, 'ch': ch, 'insulation_score': full_ins,
+                                       'boundary_strength': full_bsc})
+                df_bsc_parts[bsg].append(df_tmp)
+
+                if (mean_tad_size - expected_bins) * (mean_tad_size_prev - expected_bins) <= 0:
                     is_exp_tad_size_reached = True
-                    if abs(mean_tad_size - expected_tad_size / resolution) <= abs(mean_tad_size_prev - expected_tad_size / resolution):
+                    if abs(mean_tad_size - expected_bins) <= abs(mean_tad_size_prev - expected_bins):
                         local_optimas[window] = cov
                     else:
                         local_optimas[window_prev] = cov_prev
@@ -173,9 +167,8 @@ def boundaries(matrices, coolers, label='3-4h', expected_tad_size=60000, grid=No
                 if (bound_count_prev - tads_expected_cnt) * (bound_count - tads_expected_cnt) <= 0:
                     is_exp_tad_cnt_reached = True
 
-                if is_exp_tad_size_reached and is_exp_tad_cnt_reached and len(
-                        [x for x in bounds_cnt if str(x) != 'nan']) >= window_eps:
-                    window_cnts = np.asarray([x for x in bounds_cnt if str(x) != 'nan'][-window_eps:])
+                if is_exp_tad_size_reached and is_exp_tad_cnt_reached and len(bounds_cnt) >= window_eps:
+                    window_cnts = np.asarray(bounds_cnt, dtype=np.float64)
                     window_cnts = abs(window_cnts - tads_expected_cnt)
                     # add "and window > 150000" in the end of below if-condition if you want to limit output to the certain
                     # window value:
@@ -187,13 +180,14 @@ def boundaries(matrices, coolers, label='3-4h', expected_tad_size=60000, grid=No
                 mean_tad_size_prev = mean_tad_size
                 bound_count_prev = bound_count
 
-            local_optimas[grid[np.argmin([abs(x - expected_tad_size / resolution) for x in mean_tad_sizes])]] = covs[
-                np.argmin([abs(x - expected_tad_size / resolution) for x in mean_tad_sizes])]
+            closest_idx = int(np.argmin(np.abs(np.asarray(mean_tad_sizes, dtype=np.float64) - expected_bins)))
+            local_optimas[grid[closest_idx]] = covs[closest_idx]
             opt_window = max(local_optimas.items(), key=operator.itemgetter(1))[0]
             opt_windows_bsc[bsg] = opt_window
 
             logging.info("CALL|BOUNDARIES| Found optimal window for chrm {} and boundary strength threshold {}: {}".format(ch, bsg, opt_window))
-            _, _ = utils.produce_boundaries_segmentation(coolers[label], opt_window, ch, min_dist_bad_bin, bsg=bsg)
+            _, _ = utils.produce_boundaries_segmentation(coolers[label], opt_window, ch, min_dist_bad_bin, bsg=bsg,
+                                                         cache=boundaries_cache)
             logging.info("CALL|BOUNDARIES| End boundary strength threshold {}".format(bsg))
 
         bsc_list = []
@@ -201,7 +195,7 @@ def boundaries(matrices, coolers, label='3-4h', expected_tad_size=60000, grid=No
         for bsg in bs_grid:
             bsc_list.append(stats_bsc[bsg][opt_windows_bsc[bsg]][-1])
             # print(stats_bsc[bsg][opt_windows_bsc[bsg]][0])
-            mts_list.append(abs(stats_bsc[bsg][opt_windows_bsc[bsg]][0] - expected_tad_size / resolution))
+            mts_list.append(abs(stats_bsc[bsg][opt_windows_bsc[bsg]][0] - expected_bins))
         bsc_list, mts_list, bs_grid_new = zip(*sorted(zip(bsc_list, mts_list, bs_grid), reverse=True))
         bsc_list = list(bsc_list)
         mts_list = list(mts_list)
@@ -239,8 +233,7 @@ def boundaries(matrices, coolers, label='3-4h', expected_tad_size=60000, grid=No
         stats[ch] = stats_bsc[best_boundary_strength_threshold]
         opt_windows[ch] = best_window
 
-        sub_df = df_bsc[df_bsc.bs_threshold == best_boundary_strength_threshold]
-        sub_df.index = list(range(sub_df.shape[0]))
+        sub_df = pd.concat(df_bsc_parts[best_boundary_strength_threshold], ignore_index=True)
         df = pd.concat([df, sub_df])
 
         logging.info("CALL|BOUNDARIES| End chromosome {}".format(ch))
@@ -253,10 +246,7 @@ def boundaries(matrices, coolers, label='3-4h', expected_tad_size=60000, grid=No
     df.loc[:, 'boundary_strength'] = df.boundary_strength.values.astype(float)
     df.reset_index(drop=True, inplace=True)
 
-    df_opt = pd.DataFrame(columns=['bgn', 'end', 'bs_threshold', 'window', 'ch', 'insulation_score', 'boundary_strength'])
-    for ch in chrms:
-        df_opt = pd.concat([df_opt, df[(df['ch'] == ch) & (df['window'] == opt_windows[ch])]])
-    df_opt.reset_index(drop=True, inplace=True)
+    df_opt = df[df['window'].values == df['ch'].map(opt_windows).values].reset_index(drop=True)
 
     time_delta = time.time() - time_start
     m, s = divmod(time_delta, 60); h, m = divmod(m, 60)
@@ -266,7 +256,7 @@ def boundaries(matrices, coolers, label='3-4h', expected_tad_size=60000, grid=No
 
 
 def domains(matrices, coolers, method='armatus', label='3-4h', expected_tad_size=60000, grid=None,
-            chromnames=None, max_intertad=3, max_tad=1000, percentile=99.9, eps=1e-2):
+            chromnames=None, max_intertad=3, max_tad=1000, percentile=99.9, eps=1e-2, n_jobs=1, scan=False):
     """
     Function to call TADs.
     :param matrices: python dictionary with loaded chromosomes and stages.
@@ -285,6 +275,10 @@ def domains(matrices, coolers, method='armatus', label='3-4h', expected_tad_size
     Normally should be 99.9 or 99.99, but you could set another value.
     :param eps: delta for mean / median tad size during gamma search. Normally equal to 1e-2.
     Lower values gives you more accurate optimal gamma value in the end.
+    :param n_jobs: number of threads to produce segmentations for different gamma values in parallel
+    (-1 -- all cores, 1 -- sequentially).
+    :param scan: bool parameter - if True, grid bounds are found by the scan of all gammas of the grid instead of
+    bisection (see utils.adjust_boundaries). It may give slightly different optimal gamma values.
     :return: python dictionary with optimal gamma values for each chromosome, dataframe with segmentation for all
     gamma values in given range and dataframe with segmentation for optimal gamma values.
     """
@@ -313,13 +307,20 @@ def domains(matrices, coolers, method='armatus', label='3-4h', expected_tad_size
         logging.info("CALL|DOMAINS| Start chromosome {}".format(ch))
 
         filters, mtx, good_bins = utils.get_noisy_stripes(matrices, ch, resolution, label, percentile=percentile, method=method)
-        utils.whether_to_expand(mtx, filters, grid, ch, good_bins, method, max_intertad, max_tad, start_step)
+        utils.check_mtx(mtx)
+        segmentation_cache = {}  # segmentations for each gamma are shared between all steps of the gamma search
+        utils.whether_to_expand(mtx, filters, grid, ch, good_bins, method, max_intertad, max_tad, start_step, cache=segmentation_cache,
+                                n_jobs=n_jobs)
         adj_grid = utils.adjust_boundaries(mtx, filters, grid, ch, good_bins, method, max_intertad, max_tad, start_step, eps=eps,
-                                     type='upper')
+                                     type='upper', cache=segmentation_cache, n_jobs=n_jobs,
+                                     scan=scan)
         adj_grid = utils.adjust_boundaries(mtx, filters, adj_grid, ch, good_bins, method, max_intertad, max_tad, start_step, eps=eps,
-                                     type='lower')
-        df, opt_gamma = utils.find_global_optima(mtx, filters, adj_grid, ch, good_bins, method, max_intertad, max_tad, start_step, df, expected_tad_size, resolution)
-        df_concretized, opt_gammas = utils.adjust_global_optima(mtx, filters, opt_gamma, opt_gammas, ch, good_bins, method, max_intertad, max_tad, start_step, df_concretized, expected_tad_size, resolution, eps=eps)
+                                     type='lower', cache=segmentation_cache, n_jobs=n_jobs,
+                                     scan=scan)
+        df, opt_gamma = utils.find_global_optima(mtx, filters, adj_grid, ch, good_bins, method, max_intertad, max_tad, start_step, df, expected_tad_size, resolution,
+                                                 cache=segmentation_cache, n_jobs=n_jobs)
+        df_concretized, opt_gammas = utils.adjust_global_optima(mtx, filters, opt_gamma, opt_gammas, ch, good_bins, method, max_intertad, max_tad, start_step, df_concretized, expected_tad_size, resolution, eps=eps,
+                                                                cache=segmentation_cache, n_jobs=n_jobs)
 
         logging.info("CALL|DOMAINS| End chromosome {}".format(ch))
 
@@ -3,12 +3,12 @@ import time
 import os
 import sys
 import warnings
+from collections import OrderedDict
 
 import cooltools
 import numpy as np
 import pandas as pd
 import scipy
-from sklearn.metrics import silhouette_score
 from sklearn.preprocessing import MinMaxScaler
 
 from hichew.lib import utils
@@ -31,10 +31,10 @@ def normalize(df, columns, type_norm='z-score-row'):
     for col in columns:
         df_copy.loc[:, 'norm_{}'.format(col)] = 0
     if type_norm == 'z-score-row':
-        df_copy[['norm_{}'.format(col) for col in columns]] = np.array([x for x in df_copy.loc[:, columns].apply(scipy.stats.zscore, axis=1).values])
+        df_copy[['norm_{}'.format(col) for col in columns]] = scipy.stats.zscore(df_copy[columns].values, axis=1)
         df_copy = df_copy.dropna(axis=0, subset=['norm_{}'.format(col) for x in columns]).reset_index(drop=True)
     elif type_norm == 'z-score-col':
-        df_copy[['norm_{}'.format(col) for col in columns]] = np.array([x for x in df_copy.loc[:, columns].apply(scipy.stats.zscore, axis=0).values])
+        df_copy[['norm_{}'.format(col) for col in columns]] = scipy.stats.zscore(df_copy[columns].values, axis=0)
         df_copy = df_copy.dropna(axis=0, subset=['norm_{}'.format(col) for x in columns]).reset_index(drop=True)
     elif type_norm == 'min-max-col':
         scaler = MinMaxScaler((-1, 1))
@@ -77,9 +77,7 @@ def d_scores(df, matrices, stages, resolution=5000):
         if df_tmp.shape[0] == 0: continue
         segments = df_tmp[['bgn', 'end']].values // resolution
         for exp in stages:
-            mtx_cor = matrices[exp][ch]
-            np.fill_diagonal(mtx_cor, 0)
-            Ds = utils.get_d_score(mtx_cor, segments)
+            Ds = utils.get_d_score(matrices[exp][ch], segments)
             df_tmp.loc[:, "D_{}".format(exp)] = Ds
 
         df_tmp.reset_index(drop=True)
@@ -91,16 +89,19 @@ def d_scores(df, matrices, stages, resolution=5000):
     return df_res
 
 
-def silhouette(df, columns, clusters):
+def silhouette(df, columns, clusters, approximate=False):
     """
     Function to compute silhouette score of the clustering
     :param df: dataframe with performed clustering.
     :param columns: list of names of columns by which clustering was performed
     :param clusters: name of df column with clusters
+    :param approximate: True to compute simplified (centroid-based) silhouette score which is linear in the number
+    of TADs, False to compute exact silhouette score.
     :return: silhouette score (0 -- bad clustering, 1 -- good clustering)
     """
     try:
-        return silhouette_score(df[columns], list(df[clusters]))
+        silhouette_samples = utils.get_simplified_silhouette_samples if approximate else utils.get_silhouette_samples
+        return np.mean(silhouette_samples(df[columns].values, df[clusters].values))
     except:
         logging.info("COMPUTE|SILHOUETTE_SCORE| WARNING! CAN'T CALCULATE SILHOUETTE SCORE. IT SEEMS THAT YOU HAVE ONLY 1 CLUSTER.")
         return 0.0
@@ -124,20 +125,24 @@ def insulation_scores(df, coolers, stages, chromnames=None, ignore_diags=2):
     else:
         chrms = list(coolers.values())[0].chromnames
 
+    # chromosomes with the same optimal window are processed by a single cooltools call
+    opt_windows = df.drop_duplicates('ch').set_index('ch')['window']
+    chrms_by_window = OrderedDict()
+    for ch in chrms:
+        chrms_by_window.setdefault(int(opt_windows[ch]), []).append(ch)
+
     for stage in stages:
-        ins_scores = pd.DataFrame(
-            columns=['chrom', 'start', 'end', 'is_bad_bin', 'log2_insulation_score', 'n_valid_pixels'])
-        for ch in chrms:
-            opt_window_ch = df.query("ch=='{}'".format(ch))['window'].iloc[0]
-            sub_df = cooltools.insulation.calculate_insulation_score(coolers[stage], int(opt_window_ch),
-                                                                     ignore_diags=ignore_diags, chromosomes=[ch])
-            sub_df.rename(columns={'log2_insulation_score_{}'.format(int(opt_window_ch)): 'log2_insulation_score',
-                                   'n_valid_pixels_{}'.format(int(opt_window_ch)): 'n_valid_pixels'}, inplace=True)
-            ins_scores = pd.concat([ins_scores, sub_df])
-        ins_scores.reset_index(drop=True, inplace=True)
-        df['ins_score_{}'.format(stage)] = list(map(lambda x, y, z: ins_scores[
-            (ins_scores['start'] == x) & (ins_scores['end'] == y) & (ins_scores['chrom'] == z)][
-            'log2_insulation_score'].iloc[-1], df['bgn'], df['end'], df['ch']))
+        ins_parts = []
+        for opt_window, chrms_window in chrms_by_window.items():
+            sub_df = cooltools.insulation.calculate_insulation_score(coolers[stage], opt_window,
+                                                                     ignore_diags=ignore_diags, chromosomes=chrms_window)
+            sub_df.rename(columns={'log2_insulation_score_{}'.format(opt_window): 'log2_insulation_score',
+                                   'n_valid_pixels_{}'.format(opt_window): 'n_valid_pixels'}, inplace=True)
+            ins_parts.append(sub_df)
+        ins_scores = pd.concat(ins_parts, ignore_index=True).set_index(['chrom', 'start', 'end'])['log2_insulation_score']
+        ins_scores = ins_scores[~ins_scores.index.duplicated(keep='last')]
+        df['ins_score_{}'.format(stage)] = ins_scores.reindex(
+            pd.MultiIndex.from_arrays([df['ch'], df['bgn'], df['end']])).values
 
     segmentation = df.dropna(axis=0, subset=['ins_score_{}'.format(x) for x in stages]).reset_index(drop=True)
     time_elapsed = time.time() - in_time
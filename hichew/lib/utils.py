@@ -6,6 +6,7 @@ import lavaburst
 import cooltools.insulation
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
 
 warnings.filterwarnings("ignore")
 
@@ -21,39 +22,27 @@ def get_noisy_stripes(matrices, ch, resolution, label='3-4h', percentile=99.9, m
     :param percentile: percentile for cooler preparations and Hi-C vizualization.
     :return: Hi-C noisy stripes (bgn, end) which width is great or equal to w param value
     """
-    mtx = matrices[label][ch].copy()
+    mtx = matrices[label][ch].astype(np.float64)
     mtx[np.isnan(mtx)] = 0
     np.fill_diagonal(mtx, 0)
-    mn = np.percentile(mtx[mtx > 0], 100 - percentile)
-    mx = np.percentile(mtx[mtx > 0], percentile)
-    mtx[mtx <= mn] = mn
-    mtx[mtx >= mx] = mx
-    mtx = np.log(mtx)
-    mtx = mtx - np.min(mtx)
+    mn, mx = np.percentile(mtx[mtx > 0], [100 - percentile, percentile])
+    np.clip(mtx, mn, mx, out=mtx)
+    np.log(mtx, out=mtx)
+    mtx -= np.min(mtx)
 
     filters = {}
-    v = np.where(np.sum(mtx, axis=1) == 0)[0]
-    v_prev = v[0]
-    v_tmp = [[v[0]]]
-    for i in range(1, len(v) - 1):
-        if v[i] - v_prev == 1:
-            v_prev = v[i]
-        else:
-            v_tmp[-1].append(v_prev)
-            v_tmp.append([])
-            v_tmp[-1].append(v[i])
-            v_prev = v[i]
-    v_tmp[-1].append(v_prev)
-    v_tmp = np.array(v_tmp)
+    v = np.flatnonzero(~np.any(mtx != 0, axis=1))
+    # runs of consecutive empty bins, each one is (first bin, last bin)
+    if v.size == 0:
+        v_tmp = np.empty((0, 2), dtype=int)
+    else:
+        runs = np.split(v, np.where(np.diff(v) != 1)[0] + 1)
+        v_tmp = np.array([[run[0], run[-1]] for run in runs], dtype=int)
 
     filt = v_tmp[v_tmp[:, 1] - v_tmp[:, 0] >= 0]
 
     if method == 'insulation':
-        filt_new = []
-        for elem in filt:
-            filt_new.append([elem[0] * resolution, elem[1] * resolution + resolution])
-        filt_new = np.asarray(filt_new)
-        filters[ch] = filt_new.copy()
+        filters[ch] = filt * resolution + np.array([0, resolution])
     else:
         filters[ch] = filt.copy()
 
@@ -67,7 +56,7 @@ def get_noisy_stripes(matrices, ch, resolution, label='3-4h', percentile=99.9, m
     return filters, mtx, good_bins
 
 
-def produce_boundaries_segmentation(clr, window, ch, k=3, bsg=.0):
+def produce_boundaries_segmentation(clr, window, ch, k=3, bsg=.0, cache=None):
     """
     Function produces single segmentation (TADs boundaries calling) of mtx with one window with the algorithm provided.
     :param clr: cooler file which corresponds to single stage of development (by which we search segmentation).
@@ -77,15 +66,23 @@ def produce_boundaries_segmentation(clr, window, ch, k=3, bsg=.0):
     :param ch: chromosome name.
     :param resolution: Hi-C resolution of your coolfiles.
     :param final: bool parameter - does iteration of optimal gamma search is final?
+    :param cache: python dictionary to store boundaries found for each window. Boundaries do not depend on bsg, so
+    repeated calls with the same window (e.g. for other bsg values) reuse them instead of recomputing insulation score.
     :return: boundaries_coords -- 2D numpy array where boundaries_coords[:, 0] are boundaries starts and
     boundaries_coords[:, 1] are boundaries end, each row corresponding to one boundary;
     boundaries -- corresponding dataframe.
     """
-    ins_scores = cooltools.insulation.calculate_insulation_score(clr, int(window), ignore_diags=2, chromosomes=[ch])
-    boundaries = cooltools.insulation.find_boundaries(ins_scores, min_dist_bad_bin=k)
-    boundaries = boundaries[
-        (boundaries['boundary_strength_{}'.format(int(window))].notnull())]
-    boundaries.index = list(range(boundaries.shape[0]))
+    key = (ch, int(window), k)
+    if cache is None or key not in cache:
+        ins_scores = cooltools.insulation.calculate_insulation_score(clr, int(window), ignore_diags=2, chromosomes=[ch])
+        boundaries = cooltools.insulation.find_boundaries(ins_scores, min_dist_bad_bin=k)
+        boundaries = boundaries[
+            (boundaries['boundary_strength_{}'.format(int(window))].notnull())]
+        boundaries.index = list(range(boundaries.shape[0]))
+        if cache is not None:
+            cache[key] = boundaries
+    else:
+        boundaries = cache[key]
     boundaries_coords = np.asarray(boundaries[['start', 'end']])
 
     mask = (boundaries['boundary_strength_{}'.format(int(window))] > boundaries['boundary_strength_{}'.format(int(window))].quantile(bsg))
@@ -93,7 +90,7 @@ def produce_boundaries_segmentation(clr, window, ch, k=3, bsg=.0):
     return boundaries_coords[mask], boundaries[mask]
 
 
-def calc_mean_tad_size(boundaries, filters, ch, mis, mts, wind, resolution):
+def calc_mean_tad_size(boundaries, filters, ch, mis, mts, wind, resolution, chunk_size=4096):
     """
     Function to calculate some statistics: mean tad size, total coverage, mean insulation score.
     This function uses only in insulation method!
@@ -104,52 +101,40 @@ def calc_mean_tad_size(boundaries, filters, ch, mis, mts, wind, resolution):
     :param mts: maximum TAD size.
     :param wind: single window value.
     :param resolution: Hi-C resolution of your coolfiles.
+    :param chunk_size: number of TADs checked against filtered regions at once.
     :return: mean tad size, total chromosome coverage and mean insulation for certain window value
     """
-    select_tads = pd.DataFrame(index=list(range(boundaries.shape[0] - 1)),
-                               columns=['left_start', 'left_end', 'right_start', 'right_end', 'left_insulation',
-                                        'right_insulation', 'left_boundary_strength', 'right_boundary_strength',
-                                        'length', 'is_normal'])
-    select_tads['left_start'] = list(boundaries.iloc[:-1]['start'])
-    select_tads['left_end'] = list(boundaries.iloc[:-1]['end'])
-    select_tads['right_start'] = list(boundaries.iloc[1:]['start'])
-    select_tads['right_end'] = list(boundaries.iloc[1:]['end'])
-    select_tads['left_insulation'] = list(boundaries.iloc[:-1]['log2_insulation_score_{}'.format(int(wind))])
-    select_tads['right_insulation'] = list(boundaries.iloc[1:]['log2_insulation_score_{}'.format(int(wind))])
-    select_tads['left_boundary_strength'] = list(boundaries.iloc[:-1]['boundary_strength_{}'.format(int(wind))])
-    select_tads['right_boundary_strength'] = list(boundaries.iloc[1:]['boundary_strength_{}'.format(int(wind))])
-    select_tads['length'] = list((select_tads['right_start'] - select_tads['left_end']) / resolution)
-
-    try:
-        full_ins = list(select_tads['left_insulation']) + [list(select_tads['right_insulation'])[-1]]
-    except Exception as e:
-        full_ins = []
-    try:
-        full_bsc = list(select_tads['left_boundary_strength']) + [list(select_tads['right_boundary_strength'])[-1]]
-    except Exception as e:
-        full_bsc = []
-
-    select_tads = select_tads[(select_tads['length'] > mis) & (select_tads['length'] < mts)]
-    select_tads['is_normal'] = list(map(
-        lambda x, y: True if filters[ch][(filters[ch][:, 0] >= x) & (filters[ch][:, 1] <= y)].shape[0] == 0 else False,
-        select_tads['left_end'], select_tads['right_start']))
-    select_tads = select_tads[select_tads['is_normal'] == True]
-
-    mean_tad = np.median(select_tads['length'])
-    try:
-        mean_ins = np.median(list(select_tads['left_insulation']) + [list(select_tads['right_insulation'])[-1]])
-    except Exception as e:
-        mean_ins = np.nan
-    try:
-        mean_bsc = np.median(list(select_tads['left_boundary_strength']) + [list(select_tads['right_boundary_strength'])[-1]])
-    except Exception as e:
-        mean_bsc = np.nan
-    sum_cov = np.sum(select_tads['length'])
-
-    if np.isnan(mean_tad): mean_tad = 0
-    if np.isnan(sum_cov): sum_cov = 0
-    if np.isnan(mean_ins): mean_ins = 0
-    if np.isnan(mean_bsc): mean_bsc = 0
+    starts = boundaries['start'].values
+    ends = boundaries['end'].values
+    ins = boundaries['log2_insulation_score_{}'.format(int(wind))].values
+    bsc = boundaries['boundary_strength_{}'.format(int(wind))].values
+    # TAD is a segment between two consecutive boundaries: left is boundaries[:-1], right is boundaries[1:]
+    length = (starts[1:] - ends[:-1]) / resolution
+
+    # left values of all TADs + right value of the last one are values of all boundaries
+    full_ins, full_bsc = ins, bsc
+
+    selected = np.where((length > mis) & (length < mts))[0]
+    # TAD is normal if no filtered region lies inside it; broadcast over chunks of TADs to cap memory
+    left_end, right_start = ends[selected][:, None], starts[selected + 1][:, None]
+    is_normal = np.ones(len(selected), dtype=bool)
+    for i in range(0, len(selected), chunk_size):
+        is_normal[i:i + chunk_size] = ~((filters[ch][None, :, 0] >= left_end[i:i + chunk_size]) &
+                                        (filters[ch][None, :, 1] <= right_start[i:i + chunk_size])).any(axis=1)
+    selected = selected[is_normal]
+
+    if len(selected) == 0:
+        return 0, 0, 0, 0, full_ins, full_bsc
+
+    # boundaries of selected TADs: left ones of all selected TADs + right one of the last selected TAD
+    selected_bounds = np.append(selected, selected[-1] + 1)
+    mean_tad = np.median(length[selected])
+    sum_cov = np.sum(length[selected])
+    # insulation score of some boundaries could be NaN, then median value is treated as 0
+    mean_ins = np.median(ins[selected_bounds])
+    mean_ins = 0 if np.isnan(mean_ins) else mean_ins
+    mean_bsc = np.median(bsc[selected_bounds])
+    mean_bsc = 0 if np.isnan(mean_bsc) else mean_bsc
 
     return mean_tad, sum_cov, mean_ins, mean_bsc, full_ins, full_bsc
 
@@ -162,22 +147,12 @@ def whether_tad_noisy(x, filters, ch, method, resolution=5000, k=3):
     :param ch: chromosome name.
     :return: True if TAD is 100% noisy (lies in noisy stripe fully or partially), and False otherwise
     """
-    for bgn_f, end_f in filters[ch]:
-        if method == 'insulation':
-            bgn_f_new = bgn_f - resolution * k
-            end_f_new = end_f + resolution * k
-        else:
-            bgn_f_new = bgn_f
-            end_f_new = end_f
-        if x[0] <= end_f_new and x[0] >= bgn_f_new:
-            return True
-        if x[1] <= end_f_new and x[1] >= bgn_f_new:
-            return True
-        if x[1] <= end_f_new and x[0] >= bgn_f_new:
-            return True
-        if x[0] <= bgn_f_new and x[1] >= end_f_new:
-            return True
-    return False
+    bgn_f, end_f = filters[ch][:, 0], filters[ch][:, 1]
+    if method == 'insulation':
+        bgn_f = bgn_f - resolution * k
+        end_f = end_f + resolution * k
+    return bool(np.any(((x[0] <= end_f) & (x[0] >= bgn_f)) | ((x[1] <= end_f) & (x[1] >= bgn_f)) |
+                       ((x[1] <= end_f) & (x[0] >= bgn_f)) | ((x[0] <= bgn_f) & (x[1] >= end_f))))
 
 
 def calc_noisy_metric(x, filters, ch, method, resolution=5000, k=3):
@@ -192,40 +167,79 @@ def calc_noisy_metric(x, filters, ch, method, resolution=5000, k=3):
     If its function returns False for current TAD, then we calculate our metric.
     If True -- we return -1 value of metric.
     """
-    if whether_tad_noisy(x, filters, ch, method, resolution, k):
-        return -1
-    elif method != 'insulation':
-        try:
-            left_stripe = filters[ch][np.where(filters[ch][:, 1] == filters[ch][:, 1][
-                np.argmin(x[0] - filters[ch][:, 1][(x[0] - filters[ch][:, 1]) >= 0])])[0][0]]
-        except Exception as e:
-            left_stripe = np.array([])
-        try:
-            right_stripe = \
-                filters[ch][np.where(filters[ch][:, 0] == filters[ch][:, 0][(filters[ch][:, 0] - x[1]) >= 0][0])][0]
-        except Exception as e:
-            right_stripe = np.array([])
-        if len(left_stripe) != 0:
-            if method == 'insulation':
-                left_side_metric = (np.log(x[0] - left_stripe[1]) ** 2)
-            else:
-                left_side_metric = (np.log(x[0] - left_stripe[1]) ** 2) * np.log(x[1] - x[0])
-        else:
-            left_side_metric = 1e10
-        if len(right_stripe) != 0:
-            if method == 'insulation':
-                right_side_metric = (np.log(right_stripe[0] - x[1]) ** 2)
-            else:
-                right_side_metric = (np.log(right_stripe[0] - x[1]) ** 2) * np.log(x[1] - x[0])
-        else:
-            right_side_metric = 1e10
-        return min(left_side_metric, right_side_metric)
-    else:
-        return 1
+    # closest stripes are found by binary search over sorted stripe coordinates (see calc_noisy_metric_batch)
+    return calc_noisy_metric_batch(np.asarray(x).reshape(1, 2), filters, ch, method, resolution, k)[0]
+
+
+def whether_tad_noisy_batch(xs, filters, ch, method, resolution=5000, k=3):
+    """
+    Function determines whether TADs are noisy (vectorized version of whether_tad_noisy).
+    :param xs: 2D numpy array of TADs where xs[:, 0] are TADs begins and xs[:, 1] are TADs ends.
+    :param filters: dictionary with noisy regions.
+    :param ch: chromosome name.
+    :return: bool numpy array, True for TADs which are 100% noisy (lie in noisy stripe fully or partially)
+    """
+    xs = np.asarray(xs).reshape(-1, 2)
+    if len(filters[ch]) == 0:
+        return np.zeros(xs.shape[0], dtype=bool)
+    order = np.argsort(filters[ch][:, 0], kind='mergesort')
+    bgn_f, end_f = filters[ch][order, 0], filters[ch][order, 1]
+    if method == 'insulation':
+        bgn_f = bgn_f - resolution * k
+        end_f = end_f + resolution * k
+    # TAD overlaps some stripe iff the stripes beginning before TAD end reach TAD begin
+    idx = np.searchsorted(bgn_f, xs[:, 1], side='right') - 1
+    return (idx >= 0) & (np.maximum.accumulate(end_f)[np.maximum(idx, 0)] >= xs[:, 0])
+
+
+def calc_noisy_metric_batch(xs, filters, ch, method, resolution=5000, k=3):
+    """
+    Function to calculate noisy metric (characteristic) for each TAD (vectorized version of calc_noisy_metric).
+    :param xs: 2D numpy array of TADs where xs[:, 0] are TADs begins and xs[:, 1] are TADs ends.
+    :param filters: dictionary with noisy regions
+    :param ch: chromosome name
+    :param method: segmentation method (only armatus, modularity and insulation available).
+    :return: numpy array of heuristic metric values for noisy level determination of TADs (-1 for noisy TADs).
+    """
+    xs = np.asarray(xs, dtype=np.float64).reshape(-1, 2)
+    noisy = whether_tad_noisy_batch(xs, filters, ch, method, resolution, k)
+    if method == 'insulation':
+        return np.where(noisy, -1.0, 1.0)
+    metric = np.full(xs.shape[0], 1e10)
+    if len(filters[ch]) != 0:
+        # closest stripe which ends before TAD begin and closest stripe which begins after TAD end
+        left_ends = np.sort(filters[ch][:, 1])
+        right_starts = np.sort(filters[ch][:, 0])
+        idx_left = np.searchsorted(left_ends, xs[:, 0], side='right') - 1
+        idx_right = np.searchsorted(right_starts, xs[:, 1], side='left')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_length = np.log(xs[:, 1] - xs[:, 0])
+            left_side_metric = np.where(idx_left >= 0, (np.log(
+                xs[:, 0] - left_ends[np.maximum(idx_left, 0)]) ** 2) * log_length, 1e10)
+            right_side_metric = np.where(idx_right < len(right_starts), (np.log(
+                right_starts[np.minimum(idx_right, len(right_starts) - 1)] - xs[:, 1]) ** 2) * log_length, 1e10)
+        metric = np.minimum(left_side_metric, right_side_metric)
+    metric[noisy] = -1
+    return metric
+
+
+def check_mtx(mtx):
+    """
+    Function to check Hi-C matrix before segmentation: warns if it has NaNs or non-zero diagonal.
+    :param mtx: input numpy matrix of Hi-C contacts.
+    :return: nothing.
+    """
+    if np.any(np.isnan(mtx)):
+        logging.warning("CHECK_MTX| NaNs in dataset, please remove them first.")
+
+    if np.diagonal(mtx).sum() > 0:
+        logging.warning(
+            "CHECK_MTX| Note that diagonal is not removed. you might want to delete it to avoid "
+            "noisy and not stable results.")
 
 
 def produce_tads_segmentation(mtx, filters, gamma, ch, good_bins='default', method='armatus', max_intertad_size=3,
-                              max_tad_size=1000, final=False):
+                              max_tad_size=1000, final=False, cache=None):
     """
     Function produces single segmentation (TADs calling) of mtx with one gamma with the algorithm provided.
     :param mtx: input numpy matrix of Hi-C contacts.
@@ -237,16 +251,16 @@ def produce_tads_segmentation(mtx, filters, gamma, ch, good_bins='default', meth
     :param max_intertad_size: maximum intertad size for your method.
     :param max_tad_size: maximum TAD size.
     :param final: bool parameter - does iteration of optimal gamma search is final?
+    :param cache: python dictionary to store raw segmentations found for each gamma. Segmentation of the same
+    matrix with the same gamma does not change, so repeated calls during the gamma search reuse it instead of
+    recomputing lavaburst optimal segmentation. It should be created for each chromosome separately. If cache is
+    given, mtx is not checked for NaNs and non-zero diagonal: call check_mtx once before the gamma search.
     :return: 2D numpy array where segments[:,0] are segment starts and segments[:,1] are segments end,
     each row corresponding to one segment.
     """
-    if np.any(np.isnan(mtx)):
-        logging.warning("PRODUCE_TADS_SEGMENTATION| NaNs in dataset, please remove them first.")
-
-    if np.diagonal(mtx).sum() > 0:
-        logging.warning(
-            "PRODUCE_TADS_SEGMENTATION| Note that diagonal is not removed. you might want to delete it to avoid "
-            "noisy and not stable results.")
+    # with cache the matrix is the same for the whole gamma search and is checked once per chromosome by the caller
+    if cache is None:
+        check_mtx(mtx)
 
     if method == 'modularity':
         score = lavaburst.scoring.modularity_score
@@ -255,18 +269,23 @@ def produce_tads_segmentation(mtx, filters, gamma, ch, good_bins='default', meth
     else:
         return
 
-    if good_bins == 'default':
-        good_bins = mtx.astype(bool).sum(axis=0) > 0
+    if isinstance(good_bins, str) and good_bins == 'default':
+        good_bins = np.any(mtx != 0, axis=0)
 
-    S = score(mtx, gamma=gamma, binmask=good_bins)
-    model = lavaburst.model.SegModel(S)
-
-    segments = model.optimal_segmentation()
+    key = (method, round(gamma, 10))
+    if cache is None or key not in cache:
+        S = score(mtx, gamma=gamma, binmask=good_bins)
+        model = lavaburst.model.SegModel(S)
+        segments = model.optimal_segmentation()
+        if cache is not None:
+            cache[key] = segments
+    else:
+        segments = cache[key]
     v = segments[:, 1] - segments[:, 0]
     mask = (v > max_intertad_size) & (np.isfinite(v)) & (v < max_tad_size)
     segments = segments[mask]
 
-    metric_values = np.array([calc_noisy_metric(x, filters, ch, method, resolution=0, k=0) for x in segments])
+    metric_values = calc_noisy_metric_batch(segments, filters, ch, method, resolution=0, k=0)
     hist_arr = np.array(sorted(metric_values))
     hist_arr = hist_arr[hist_arr > 0]
     try:
@@ -283,7 +302,37 @@ def produce_tads_segmentation(mtx, filters, gamma, ch, good_bins='default', meth
         return segments
 
 
-def whether_to_expand(mtx, filters, grid, ch, good_bins, method, mis, mts, start_step):
+def get_ndigits(step):
+    """
+    Function to get number of digits after the decimal point of the gamma search step (used for grid rounding).
+    :param step: start step to search optimal gamma value.
+    :return: number of digits after the decimal point (at least 1).
+    """
+    return max(len('{:.10f}'.format(step).rstrip('0').split('.')[1]), 1)
+
+
+def produce_tads_segmentation_batch(mtx, filters, gammas, ch, good_bins, method, mis, mts, cache=None, n_jobs=1):
+    """
+    Function produces segmentations (TADs calling) of mtx for several gamma values. Segmentations for different
+    gammas are independent, so they are produced in n_jobs threads.
+    :param mtx: input numpy matrix of Hi-C contacts.
+    :param filters: regions of Hi-C map that should be ignored (white stripes).
+    :param gammas: list of gamma values.
+    :param ch: chromosome name.
+    :param good_bins: bool mask of good bins.
+    :param method: armatus or modularity to produce segmentation.
+    :param mis: maximum intertad size for your method.
+    :param mts: maximum TAD size.
+    :param cache: python dictionary to store segmentations found for each gamma (see produce_tads_segmentation).
+    :param n_jobs: number of threads (-1 to use all cores, 1 to produce segmentations sequentially).
+    :return: list of segmentations (see produce_tads_segmentation) in the order of gammas.
+    """
+    return Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(produce_tads_segmentation)(mtx, filters, g, ch, good_bins=good_bins, method=method, max_intertad_size=mis,
+                                           max_tad_size=mts, cache=cache) for g in gammas)
+
+
+def whether_to_expand(mtx, filters, grid, ch, good_bins, method, mis, mts, start_step, cache=None, n_jobs=1):
     """
     Function to check whether we could expand given grid.
     :param mtx: input numpy matrix of Hi-C contacts.
@@ -295,30 +344,29 @@ def whether_to_expand(mtx, filters, grid, ch, good_bins, method, mis, mts, start
     :param mis: maximum intertad size for your method.
     :param mts: maximum TAD size.
     :param start_step: start step to search optimal gamma value. It is equal to step in grid param.
+    :param cache: python dictionary to store segmentations found for each gamma (see produce_tads_segmentation).
+    :param n_jobs: number of threads to produce segmentations for different gammas in parallel.
     :return: nothing.
     """
+    ndigits = get_ndigits(start_step)
     upper_check = np.arange(grid[-1] + start_step, grid[-1] + start_step * 11, start_step)
     lower_check = np.arange(grid[0] - start_step * 10, grid[0], start_step)
     if start_step != 1:
-        upper_check = np.array([round(x, len(str(start_step).split('.')[1])) for x in upper_check])
-        lower_check = np.array([round(x, len(str(start_step).split('.')[1])) for x in lower_check])
+        upper_check = np.round(upper_check, ndigits)
+        lower_check = np.round(lower_check, ndigits)
     len_upper_segments = []
     len_lower_segments = []
 
     if not any(x < 0 for x in upper_check):
-        for g in upper_check:
-            len_upper_segments.append(len(list(produce_tads_segmentation(mtx, filters, g, ch, good_bins=good_bins,
-                                                                         method=method, max_intertad_size=mis,
-                                                                         max_tad_size=mts))))
+        len_upper_segments.extend([len(segments) for segments in produce_tads_segmentation_batch(
+            mtx, filters, upper_check, ch, good_bins, method, mis, mts, cache=cache, n_jobs=n_jobs)])
     else:
         logging.error("WHETHER_TO_EXPAND| Your grid upper bound is probably negative! Please, select positive upper bound!")
         return
 
     if not any(x < 0 for x in lower_check):
-        for g in lower_check:
-            len_upper_segments.append(len(list(produce_tads_segmentation(mtx, filters, g, ch, good_bins=good_bins,
-                                                                         method=method, max_intertad_size=mis,
-                                                                         max_tad_size=mts))))
+        len_upper_segments.extend([len(segments) for segments in produce_tads_segmentation_batch(
+            mtx, filters, lower_check, ch, good_bins, method, mis, mts, cache=cache, n_jobs=n_jobs)])
     else:
         first_nonnegative_gamma = np.argmax(lower_check >= 0)
         if first_nonnegative_gamma == 0 and lower_check[first_nonnegative_gamma] < 0 and grid[0] != 0:
@@ -327,10 +375,9 @@ def whether_to_expand(mtx, filters, grid, ch, good_bins, method, mis, mts, start
         elif grid[0] == 0:
             pass
         else:
-            for g in lower_check[first_nonnegative_gamma:]:
-                len_lower_segments.append(len(list(produce_tads_segmentation(mtx, filters, g, ch, good_bins=good_bins,
-                                                                             method=method, max_intertad_size=mis,
-                                                                             max_tad_size=mts))))
+            len_lower_segments.extend([len(segments) for segments in produce_tads_segmentation_batch(
+                mtx, filters, lower_check[first_nonnegative_gamma:], ch, good_bins, method, mis, mts, cache=cache,
+                n_jobs=n_jobs)])
 
     if len(set(len_upper_segments)) > 1:
         logging.error("WHETHER_TO_EXPAND| Upper bound could be expanded! Gamma optima would be missed!")
@@ -340,7 +387,8 @@ def whether_to_expand(mtx, filters, grid, ch, good_bins, method, mis, mts, start
         return
 
 
-def adjust_boundaries(mtx, filters, grid, ch, good_bins, method, mis, mts, start_step, eps=1e-2, type='upper'):
+def adjust_boundaries(mtx, filters, grid, ch, good_bins, method, mis, mts, start_step, eps=1e-2, type='upper',
+                      cache=None, n_jobs=1, scan=False):
     """
     Function to adjust grid's boundaries.
     :param mtx: input numpy matrix of Hi-C contacts.
@@ -355,46 +403,65 @@ def adjust_boundaries(mtx, filters, grid, ch, good_bins, method, mis, mts, start
     :param eps: delta for mean tad size during gamma search. Normally equal to 1e-2.
     Lower values gives you more accurate optimal gamma value in the end.
     :param type: type of boundary to adjust - lower or upper.
+    :param cache: python dictionary to store segmentations found for each gamma (see produce_tads_segmentation).
+    :param n_jobs: number of threads to produce segmentations for different gammas in parallel (used only with scan).
+    :param scan: bool parameter - if True, segmentations for all gammas of the grid are produced (in n_jobs threads)
+    and the bound is found by the scan of segments counts instead of the sequential bisection. Scan lands exactly on
+    the end of the plateau of segments count, while bisection can stop one grid step before it, so the adjusted grid
+    (and optimal gamma) may differ.
     :return: adjusted grid.
     """
     logging.info("ADJUST_BOUNDARIES| Start searching gamma {} bound for chromosome {}...".format(type, ch))
+    ndigits = get_ndigits(start_step)
     if start_step != 1:
-        grid = np.asarray([round(x, len(str(start_step).split('.')[1])) for x in grid])
-    len_segments_prev = [0]
-    bound_1 = grid[-1] if type == 'upper' else grid[0]
-    bound_1_prev = grid[-1] if type == 'upper' else grid[0]
-    bound_2 = grid[0] if type == 'upper' else grid[-1]
-    delta = len(grid)
-
-    is_begin = True
-
-    while delta > 1:
-        len_segments = len(list(produce_tads_segmentation(mtx, filters, bound_1, ch, good_bins=good_bins,
-                                                          method=method, max_intertad_size=mis, max_tad_size=mts)))
-        if is_begin:
-            len_segments_prev = len_segments
-            is_begin = False
-
-        if len_segments != len_segments_prev:
-            bound_2 = bound_1
-            if start_step != 1:
-                bound_1 = round((bound_1 + bound_1_prev) / 2, len(str(start_step).split('.')[1]))
-            else:
-                bound_1 = round((bound_1 + bound_1_prev) / 2)
+        grid = np.round(np.asarray(grid), ndigits)
+    if scan:
+        # bound is the end of the plateau of segments count adjacent to the opposite end of the grid
+        counts = np.array([len(segments) for segments in produce_tads_segmentation_batch(
+            mtx, filters, grid, ch, good_bins, method, mis, mts, cache=cache, n_jobs=n_jobs)])
+        if type == 'upper':
+            changed = np.where(counts != counts[-1])[0]
+            bound_1 = grid[changed[-1] + 1] if len(changed) > 0 else grid[0]
         else:
-            len_segments_prev = len_segments
-            bound_1_prev = bound_1
-            if start_step != 1:
-                bound_1 = round((bound_1 + bound_2) / 2, len(str(start_step).split('.')[1]))
+            changed = np.where(counts != counts[0])[0]
+            bound_1 = grid[changed[0] - 1] if len(changed) > 0 else grid[-1]
+    else:
+        len_segments_prev = [0]
+        bound_1 = grid[-1] if type == 'upper' else grid[0]
+        bound_1_prev = grid[-1] if type == 'upper' else grid[0]
+        bound_2 = grid[0] if type == 'upper' else grid[-1]
+        delta = len(grid)
+
+        is_begin = True
+
+        while delta > 1:
+            len_segments = len(list(produce_tads_segmentation(mtx, filters, bound_1, ch, good_bins=good_bins,
+                                                              method=method, max_intertad_size=mis, max_tad_size=mts,
+                                                              cache=cache)))
+            if is_begin:
+                len_segments_prev = len_segments
+                is_begin = False
+
+            if len_segments != len_segments_prev:
+                bound_2 = bound_1
+                if start_step != 1:
+                    bound_1 = round((bound_1 + bound_1_prev) / 2, ndigits)
+                else:
+                    bound_1 = round((bound_1 + bound_1_prev) / 2)
             else:
-                bound_1 = round((bound_1 + bound_2) / 2)
-        delta = abs(int(np.argwhere(grid == bound_1)) - int(np.argwhere(grid == bound_2)))
+                len_segments_prev = len_segments
+                bound_1_prev = bound_1
+                if start_step != 1:
+                    bound_1 = round((bound_1 + bound_2) / 2, ndigits)
+                else:
+                    bound_1 = round((bound_1 + bound_2) / 2)
+            delta = abs(int(np.argwhere(grid == bound_1)) - int(np.argwhere(grid == bound_2)))
 
     bound_gamma_fixed = bound_1
     adj_grid = np.arange(grid[0], grid[np.where(grid == bound_gamma_fixed)[0][0]] + start_step, start_step) \
         if type == 'upper' else np.arange(grid[np.where(grid == bound_gamma_fixed)[0][0]], grid[-1] + start_step, start_step)
     if start_step != 1 and type != 'upper':
-        adj_grid = np.array([round(x, len(str(start_step).split('.')[1])) for x in adj_grid])
+        adj_grid = np.round(adj_grid, ndigits)
     logging.info("ADJUST_BOUNDARIES| Found gamma {} bound: {}".format(type, bound_gamma_fixed))
     if adj_grid[-1] - adj_grid[0] - start_step <= eps and type != 'upper':
         logging.error("ADJUST_BOUNDARIES| You probably out of gamma region of interest! Please, change the grid!")
@@ -403,7 +470,8 @@ def adjust_boundaries(mtx, filters, grid, ch, good_bins, method, mis, mts, start
         return adj_grid
 
 
-def find_global_optima(mtx, filters, adj_grid, ch, good_bins, method, mis, mts, start_step, df, expected, resolution):
+def find_global_optima(mtx, filters, adj_grid, ch, good_bins, method, mis, mts, start_step, df, expected, resolution,
+                       cache=None, n_jobs=1):
     """
     Function to find global gamma optima by the given adjusted (or not) grid.
     :param mtx: input numpy matrix of Hi-C contacts.
@@ -418,24 +486,25 @@ def find_global_optima(mtx, filters, adj_grid, ch, good_bins, method, mis, mts,
     :param df: dataframe to fill segmentation for current chromosome.
     :param expected: tad size to be expected. For Drosophila melanogaster it could be 120000, 60000 or 30000 bp.
     :param resolution: Hi-C resolution of your coolfiles.
+    :param cache: python dictionary to store segmentations found for each gamma (see produce_tads_segmentation).
+    :param n_jobs: number of threads to produce segmentations for different gammas in parallel.
     :return: renew dataframe with segmentation of current chromosome and optimal gamma for this segmentation.
     """
     logging.info("FIND_GLOBAL_OPTIMA| Running TAD search using new adgusted grid for chromosome {}...".format(ch))
 
+    expected_bins = expected / resolution
     new_grid = np.arange(adj_grid[0], adj_grid[-1] + start_step, start_step)
 
-    segments_0 = produce_tads_segmentation(mtx, filters, new_grid[0], ch, good_bins=good_bins,
-                                           method=method, max_intertad_size=mis, max_tad_size=mts)
+    segmentations = produce_tads_segmentation_batch(mtx, filters, new_grid, ch, good_bins, method, mis, mts, cache=cache,
+                                                    n_jobs=n_jobs)
+    segments_0 = segmentations[0]
     mean_tad_size_prev = np.mean(segments_0[:, 1] - segments_0[:, 0])
     gamma_prev = new_grid[0]
     cov_prev = np.sum(segments_0[:, 1] - segments_0[:, 0])
 
-    df_tmp = pd.DataFrame(columns=['bgn', 'end', 'gamma', 'method'], index=np.arange(len(segments_0)))
-    df_tmp.loc[:, ['bgn', 'end']] = segments_0
-    df_tmp['gamma'] = new_grid[0]
-    df_tmp['method'] = method
-    df_tmp['ch'] = ch
-    df = pd.concat([df, df_tmp])
+    # segmentations for all gammas are collected and concatenated once after the loop
+    parts = [df, pd.DataFrame({'bgn': segments_0[:, 0], 'end': segments_0[:, 1], 'gamma': new_grid[0],
+                               'method': method, 'ch': ch}, columns=['bgn', 'end', 'gamma', 'method', 'ch'])]
 
     local_optimas = {}
     mean_tad_sizes = []
@@ -443,23 +512,17 @@ def find_global_optima(mtx, filters, adj_grid, ch, good_bins, method, mis, mts,
     mean_tad_sizes.append(mean_tad_size_prev)
     covs.append(cov_prev)
 
-    for gamma in new_grid[1:]:
-        segments = produce_tads_segmentation(mtx, filters, gamma, ch, good_bins=good_bins,
-                                             method=method, max_intertad_size=mis, max_tad_size=mts)
+    for gamma, segments in zip(new_grid[1:], segmentations[1:]):
         mean_tad_size = np.mean(segments[:, 1] - segments[:, 0])
         mean_tad_sizes.append(mean_tad_size)
         cov = np.sum(segments[:, 1] - segments[:, 0])
         covs.append(cov)
 
-        df_tmp = pd.DataFrame(columns=['bgn', 'end', 'gamma', 'method'], index=np.arange(len(segments)))
-        df_tmp.loc[:, ['bgn', 'end']] = segments
-        df_tmp['gamma'] = gamma
-        df_tmp['method'] = method
-        df_tmp['ch'] = ch
-        df = pd.concat([df, df_tmp])
+        parts.append(pd.DataFrame({'bgn': segments[:, 0], 'end': segments[:, 1], 'gamma': gamma, 'method': method,
+                                   'ch': ch}, columns=['bgn', 'end', 'gamma', 'method', 'ch']))
 
-        if (mean_tad_size - expected / resolution) * (mean_tad_size_prev - expected / resolution) <= 0:
-            if abs(mean_tad_size - expected / resolution) <= abs(mean_tad_size_prev - expected / resolution):
+        if (mean_tad_size - expected_bins) * (mean_tad_size_prev - expected_bins) <= 0:
+            if abs(mean_tad_size - expected_bins) <= abs(mean_tad_size_prev - expected_bins):
                 local_optimas[gamma] = cov
             else:
                 local_optimas[gamma_prev] = cov_prev
@@ -468,8 +531,10 @@ def find_global_optima(mtx, filters, adj_grid, ch, good_bins, method, mis, mts,
         cov_prev = cov
         mean_tad_size_prev = mean_tad_size
 
-    local_optimas[new_grid[np.argmin([abs(x - expected / resolution) for x in mean_tad_sizes])]] = covs[
-        np.argmin([abs(x - expected / resolution) for x in mean_tad_sizes])]
+    df = pd.concat(parts, ignore_index=True)
+
+    closest_idx = int(np.argmin(np.abs(np.asarray(mean_tad_sizes, dtype=np.float64) - expected_bins)))
+    local_optimas[new_grid[closest_idx]] = covs[closest_idx]
     opt_gamma = max(local_optimas.items(), key=operator.itemgetter(1))[0]
 
     logging.info("FIND_GLOBAL_OPTIMA| Found optimal gamma for chromosome {}: {}".format(ch, opt_gamma))
@@ -477,7 +542,8 @@ def find_global_optima(mtx, filters, adj_grid, ch, good_bins, method, mis, mts,
     return df, opt_gamma
 
 
-def adjust_global_optima(mtx, filters, opt_gamma, opt_gammas, ch, good_bins, method, mis, mts, start_step, df_concretized, expected, resolution, eps=1e-2):
+def adjust_global_optima(mtx, filters, opt_gamma, opt_gammas, ch, good_bins, method, mis, mts, start_step, df_concretized, expected, resolution, eps=1e-2,
+                         cache=None, n_jobs=1):
     """
     Function to adjust global optima gamma value to achieve more accurate segmentation.
     :param mtx: input numpy matrix of Hi-C contacts.
@@ -495,50 +561,48 @@ def adjust_global_optima(mtx, filters, opt_gamma, opt_gammas, ch, good_bins, met
     :param resolution: Hi-C resolution of your coolfiles.
     :param eps: delta for mean tad size during gamma search. Normally equal to 1e-2.
     Lower values gives you more accurate optimal gamma value in the end.
+    :param cache: python dictionary to store segmentations found for each gamma (see produce_tads_segmentation).
+    :param n_jobs: number of threads to produce segmentations for different gammas in parallel.
     :return: renew dataframe with optimal segmentation of current chromosome and python dictionary with
     optimal gamma for this segmentation.
     """
     logging.info("ADJUST_GLOBAL_OPTIMA| Running TAD search to concretize optimal gamma for chromosome {0} "
                  "reducing the step of search...".format(ch))
+    expected_bins = expected / resolution
     segments = produce_tads_segmentation(mtx, filters, opt_gamma, ch, good_bins=good_bins,
-                                         method=method, max_intertad_size=mis, max_tad_size=mts)
+                                         method=method, max_intertad_size=mis, max_tad_size=mts, cache=cache)
     mean_tad_size = np.mean(segments[:, 1] - segments[:, 0])
-    mts_prev = abs(expected / resolution - mean_tad_size)
+    mts_prev = abs(expected_bins - mean_tad_size)
 
     new_opt_gamma = opt_gamma
     step = start_step
     new_grid = np.arange(new_opt_gamma - step, new_opt_gamma + step, step / 10)
-    mean_tad_size = []
-    for gamma in new_grid:
-        segments = produce_tads_segmentation(mtx, filters, gamma, ch, good_bins=good_bins,
-                                             method=method, max_intertad_size=mis, max_tad_size=mts)
-        mean_tad_size.append(np.mean(segments[:, 1] - segments[:, 0]))
-
-    new_opt_gamma = new_grid[np.argmin([abs(x - expected / resolution) for x in mean_tad_size])]
-    mts_cur = np.min([abs(x - expected / resolution) for x in mean_tad_size])
+    mean_tad_size = [np.mean(segments[:, 1] - segments[:, 0]) for segments in produce_tads_segmentation_batch(
+        mtx, filters, new_grid, ch, good_bins, method, mis, mts, cache=cache, n_jobs=n_jobs)]
+
+    diffs = np.abs(np.asarray(mean_tad_size, dtype=np.float64) - expected_bins)
+    closest_idx = int(np.argmin(diffs))
+    new_opt_gamma = new_grid[closest_idx]
+    mts_cur = diffs[closest_idx]
     step /= 10
 
     while abs(mts_cur - mts_prev) > eps:
         mts_prev = mts_cur
         new_grid = np.arange(new_opt_gamma - step, new_opt_gamma + step, step / 10)
-        mean_tad_size = []
-        for gamma in new_grid:
-            segments = produce_tads_segmentation(mtx, filters, gamma, ch, good_bins=good_bins,
-                                                 method=method, max_intertad_size=mis, max_tad_size=mts)
-            mean_tad_size.append(np.mean(segments[:, 1] - segments[:, 0]))
-
-        new_opt_gamma = new_grid[np.argmin([abs(x - expected / resolution) for x in mean_tad_size])]
-        mts_cur = np.min([abs(x - expected / resolution) for x in mean_tad_size])
+        mean_tad_size = [np.mean(segments[:, 1] - segments[:, 0]) for segments in produce_tads_segmentation_batch(
+            mtx, filters, new_grid, ch, good_bins, method, mis, mts, cache=cache, n_jobs=n_jobs)]
+
+        diffs = np.abs(np.asarray(mean_tad_size, dtype=np.float64) - expected_bins)
+        closest_idx = int(np.argmin(diffs))
+        new_opt_gamma = new_grid[closest_idx]
+        mts_cur = diffs[closest_idx]
         step /= 10
 
     segments = produce_tads_segmentation(mtx, filters, new_opt_gamma, ch, good_bins=good_bins,
-                                         method=method, max_intertad_size=mis, max_tad_size=mts, final=True)
-    df_tmp = pd.DataFrame(columns=['bgn', 'end', 'gamma', 'method'], index=np.arange(len(segments)))
-    df_tmp.loc[:, ['bgn', 'end']] = segments
-    df_tmp['gamma'] = new_opt_gamma
-    df_tmp['method'] = method
-    df_tmp['ch'] = ch
-    df_concretized = pd.concat([df_concretized, df_tmp])
+                                         method=method, max_intertad_size=mis, max_tad_size=mts, final=True, cache=cache)
+    df_tmp = pd.DataFrame({'bgn': segments[:, 0], 'end': segments[:, 1], 'gamma': new_opt_gamma, 'method': method,
+                           'ch': ch}, columns=['bgn', 'end', 'gamma', 'method', 'ch'])
+    df_concretized = pd.concat([df_concretized, df_tmp], ignore_index=True)
 
     opt_gammas[ch] = new_opt_gamma
 
@@ -554,15 +618,114 @@ def get_d_score(mtx, segmentation):
     :param segmentation: optimal segmentation that we want to map on mtx and then calculate D-scores.
     :return: D-scores for each TAD.
     """
+    segmentation = np.asarray(segmentation, dtype=int).reshape(-1, 2)
     l = len(mtx)
-    segments = np.concatenate([np.array([[0, 0]]), segmentation, np.array([[l, l]])])
+    p3 = np.clip(segmentation[:, 0], 0, l)
+    p4 = np.clip(segmentation[:, 1], p3, l)
+
+    # sums over TAD rectangles are taken from integral image (2D prefix sums), so each sum costs four lookups
+    integral = np.zeros((l + 1, l + 1))
+    integral[1:, 1:] = mtx
+    np.nan_to_num(integral, copy=False)
+    diag = np.concatenate([[0], np.cumsum(np.diagonal(integral)[1:])])
+    np.cumsum(integral, axis=0, out=integral)
+    np.cumsum(integral, axis=1, out=integral)
 
-    Ds = []
-    for i in range(1, len(segments) - 1):
-        _, _, p3, p4, _, _ = *segments[i - 1, :], *segments[i, :], *segments[i + 1, :]
-        intra = np.nansum(mtx[:p3, p3:p4]) + np.nansum(mtx[p4:, p3:p4])
-        inter = (np.nansum(mtx[p3:p4, p3:p4]) - np.trace(mtx[p3:p4, p3:p4])) / 2
-        D = inter / intra
-        Ds.append(D)
+    intra = integral[p3, p4] - integral[0, p4] - integral[p3, p3] + integral[0, p3] + \
+            integral[l, p4] - integral[p4, p4] - integral[l, p3] + integral[p4, p3]
+    inter = (integral[p4, p4] - integral[p3, p4] - integral[p4, p3] + integral[p3, p3] - (diag[p4] - diag[p3])) / 2
+    Ds = inter / intra
 
-    return Ds
+    return list(Ds)
+
+
+def get_silhouette_samples(X, labels, chunk_size=1024):
+    """
+    Function to calculate silhouette coefficient (euclidean metric) for each sample.
+    :param X: 2D numpy array of features where rows correspond to samples.
+    :param labels: cluster label for each sample.
+    :param chunk_size: number of rows of distance matrix to keep in memory at once.
+    :return: numpy array of silhouette coefficients for each sample.
+    """
+    return get_silhouette_samples_batch(X, [labels], chunk_size=chunk_size)[0]
+
+
+def get_silhouette_samples_batch(X, labelings, chunk_size=1024):
+    """
+    Function to calculate silhouette coefficients (euclidean metric) of the same samples for several clusterings
+    at once. Distances are computed for chunk_size rows at a time and reduced to per-cluster sums of all clusterings
+    with a single matrix product with concatenated one-hot cluster matrices, so distance matrix is computed once
+    for all clusterings and peak memory is O(chunk_size * N) instead of O(N^2).
+    :param X: 2D numpy array of features where rows correspond to samples.
+    :param labelings: list of arrays of cluster labels for each sample (one array per clustering).
+    :param chunk_size: number of rows of distance matrix to keep in memory at once.
+    :return: list of numpy arrays of silhouette coefficients for each sample (one array per clustering).
+    """
+    X = np.asarray(X, dtype=np.float64)
+    n = X.shape[0]
+    # columns of concatenated one-hot matrix that belong to each clustering, with labels shifted accordingly
+    offsets, codes = [0], []
+    for labels in labelings:
+        uniq, labels = np.unique(labels, return_inverse=True)
+        if not 1 < len(uniq) < n:
+            raise Exception("Number of labels is {}. Valid values are 2 to n_samples - 1 (inclusive)".format(len(uniq)))
+        codes.append(labels + offsets[-1])
+        offsets.append(offsets[-1] + len(uniq))
+    onehot = np.zeros((n, offsets[-1]))
+    for labels in codes:
+        onehot[np.arange(n), labels] = 1
+    counts = onehot.sum(axis=0)
+    sq_norms = np.einsum('ij,ij->i', X, X)
+
+    sils = [np.zeros(n) for _ in labelings]
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        rows = np.arange(stop - start)
+        dist = sq_norms[start:stop, None] + sq_norms[None, :] - 2 * np.dot(X[start:stop], X.T)
+        np.maximum(dist, 0, out=dist)
+        np.sqrt(dist, out=dist)
+        dist[rows, np.arange(start, stop)] = 0
+        cluster_dists = np.dot(dist, onehot)
+
+        for j, labels in enumerate(codes):
+            own = labels[start:stop]
+            a = cluster_dists[rows, own] / np.maximum(counts[own] - 1, 1)
+            mean_dists = cluster_dists[:, offsets[j]:offsets[j + 1]] / counts[offsets[j]:offsets[j + 1]]
+            mean_dists[rows, own - offsets[j]] = np.inf
+            b = mean_dists.min(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                s = (b - a) / np.maximum(a, b)
+            sils[j][start:stop] = np.where(counts[own] > 1, np.nan_to_num(s), 0)
+
+    return sils
+
+
+def get_simplified_silhouette_samples(X, labels):
+    """
+    Function to calculate simplified silhouette coefficient (euclidean metric) for each sample: a(i) and b(i) are
+    distances to the centroid of own cluster and to the nearest centroid of other cluster respectively, instead of
+    mean distances to all samples of clusters. It is O(N * k) instead of O(N^2), but it is an approximation.
+    :param X: 2D numpy array of features where rows correspond to samples.
+    :param labels: cluster label for each sample.
+    :return: numpy array of simplified silhouette coefficients for each sample.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    uniq, labels = np.unique(labels, return_inverse=True)
+    if not 1 < len(uniq) < X.shape[0]:
+        raise Exception("Number of labels is {}. Valid values are 2 to n_samples - 1 (inclusive)".format(len(uniq)))
+    counts = np.bincount(labels)
+    centroids = np.zeros((len(uniq), X.shape[1]))
+    np.add.at(centroids, labels, X)
+    centroids /= counts[:, None]
+
+    dist = np.einsum('ij,ij->i', X, X)[:, None] + np.einsum('ij,ij->i', centroids, centroids)[None, :] - \
+           2 * np.dot(X, centroids.T)
+    np.maximum(dist, 0, out=dist)
+    np.sqrt(dist, out=dist)
+    rows = np.arange(X.shape[0])
+    a = dist[rows, labels].copy()
+    dist[rows, labels] = np.inf
+    b = dist.min(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = (b - a) / np.maximum(a, b)
+    return np.where(counts[labels] > 1, np.nan_to_num(s), 0)
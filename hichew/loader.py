@@ -45,7 +45,7 @@ def cool_files(path, resolution=5000, chromnames=None, stages=None):
     logging.info("LOADER|COOL_FILES| Start loading coolfiles...")
     in_time = time.time()
 
-    for label, file in list(zip(labels, files)):
+    for label, file in zip(labels, files):
         if splitext(basename(file))[1] == '.mcool':
             c = cooler.Cooler(file + '::/resolutions/{}'.format(resolution))
         elif splitext(basename(file))[1] == '.cool':
@@ -61,9 +61,9 @@ def cool_files(path, resolution=5000, chromnames=None, stages=None):
         else:
             chrms = c.chromnames
 
+        selector = c.matrix(balance=True)
         for ch in chrms:
-            mtx = c.matrix(balance=True).fetch(ch)
-            matrices[label][ch] = mtx.copy()
+            matrices[label][ch] = selector.fetch(ch)
 
     time_elapsed = time.time() - in_time
     logging.info("LOADER|COOL_FILES| Loading completed in {:.0f}m {:.0f}s".format(time_elapsed // 60, time_elapsed % 60))
@@ -9,8 +9,10 @@ import json
 
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import mpl_toolkits.axisartist as AA
 import numpy as np
+import pandas as pd
 import seaborn as sns
 from mpl_toolkits.axes_grid1 import host_subplot
 from mpl_toolkits.mplot3d import Axes3D
@@ -36,23 +38,23 @@ def clusters_dynamics(df, columns, clusters):
 
     fig, axes = plt.subplots(n_clusters, 1, sharey=True, figsize=[5, int(15 * n_clusters / 4)])
 
+    values = df[columns].values
+    lines = np.stack([np.broadcast_to(np.arange(values.shape[1]), values.shape), values], axis=-1)
     v_pres = {}
-    for v, (i, r) in zip(df[clusters], df.iterrows()):
-        color = colors[v]
-        if not v in v_pres.keys():
-            v_pres[v] = 0
-            try:
-                axes[v].plot(r[columns], label=v, color=color, alpha=0.1)
-            except:
-                axes.plot(r[columns], label=v, color=color, alpha=0.1)
-        else:
-            try:
-                axes[v].plot(r[columns].values, color=color, alpha=0.1)
-            except:
-                axes.plot(r[columns].values, color=color, alpha=0.1)
-        v_pres[v] += 1
+    cluster_labels = df[clusters].values
+    for v in pd.unique(cluster_labels):
+        lines_v = lines[cluster_labels == v]
+        try:
+            axes[v].add_collection(LineCollection(lines_v, colors=[colors[v]], alpha=0.1))
+            axes[v].autoscale_view()
+            axes[v].set_xticks(range(len(columns)))
+        except:
+            axes.add_collection(LineCollection(lines_v, colors=[colors[v]], alpha=0.1))
+            axes.autoscale_view()
+            axes.set_xticks(range(len(columns)))
+        v_pres[v] = len(lines_v)
 
-    centroids = [list(np.mean(df[df[clusters] == nk][columns])) for nk in range(n_clusters)]
+    centroids = df.groupby(clusters)[columns].mean().reindex(range(n_clusters)).values
     for v, c in enumerate(centroids):
         color = colors1[v]
         try:
@@ -90,14 +92,12 @@ def _pca(df, columns, clusters):
     n_clusters = len(set(df[clusters]))
 
     if len(columns) >= 3:
-        pca = PCA(n_components=3)
+        pca = PCA(n_components=3, copy=False, svd_solver='randomized')
     else:
-        pca = PCA(n_components=2)
+        pca = PCA(n_components=2, copy=False, svd_solver='randomized')
 
-    pca_result = pca.fit_transform(df[columns].values)
-    df_pca = df.copy()
-    df_pca['pca-one'] = pca_result[:, 0]
-    df_pca['pca-two'] = pca_result[:, 1]
+    pca_result = pca.fit_transform(np.ascontiguousarray(df[columns].values, dtype=np.float32))
+    df_pca = pd.DataFrame({'pca-one': pca_result[:, 0], 'pca-two': pca_result[:, 1], clusters: df[clusters].values})
 
     if len(columns) >= 3:
         df_pca['pca-three'] = pca_result[:, 2]
@@ -148,11 +148,9 @@ def _tsne(df, columns, clusters, perplexity=30, rs=42):
 
     time_start = time.time()
     tsne = TSNE(n_components=2, perplexity=perplexity, random_state=rs)
-    tsne_results = tsne.fit_transform(df[columns])
+    tsne_results = tsne.fit_transform(np.ascontiguousarray(df[columns].values, dtype=np.float32))
     logging.info("PLOT|TSNE| t-SNE done! Time elapsed: {} seconds".format(time.time() - time_start))
-    df_tsne = df.copy()
-    df_tsne['tsne-2d-one'] = tsne_results[:, 0]
-    df_tsne['tsne-2d-two'] = tsne_results[:, 1]
+    df_tsne = pd.DataFrame({'tsne-2d-one': tsne_results[:, 0], 'tsne-2d-two': tsne_results[:, 1], clusters: df[clusters].values})
     plt.figure(figsize=(16, 10))
     sns.scatterplot(
         x="tsne-2d-one", y="tsne-2d-two",
@@ -184,12 +182,13 @@ def viz_opt_curves(df, opt_df, method, chromnames, expected_mts=60000, mts=1000,
     for ch in chromnames:
         if method == 'insulation':
             od = collections.OrderedDict(sorted(df[ch].items()))
-            gr_mean = [od[i][0] for i in od]
-            # gr_cov = [od[i][1] for i in od]
-            # gr_count = [od[i][2] for i in od]
-            gr_ins = [od[i][3] for i in od]
-            gr_bsc = [od[i][4] for i in od]
-            w_range = [i for i in od]
+            vals = np.array(list(od.values()))
+            gr_mean = vals[:, 0]
+            # gr_cov = vals[:, 1]
+            # gr_count = vals[:, 2]
+            gr_ins = vals[:, 3]
+            gr_bsc = vals[:, 4]
+            w_range = list(od)
         else:
             gr_mean = df.query('ch=="{}"'.format(ch)).groupby(['gamma', 'ch']).mean().reset_index().sort_values(['ch', 'gamma'])
             gr_count = df.query('ch=="{}"'.format(ch)).groupby(['gamma', 'ch']).count().reset_index().sort_values(
@@ -272,7 +271,7 @@ def viz_tads(df, datasets, begin=0, end=100, ch='chrX', exp='3-4h', resolution=5
 
     df_tmp = df.query("ch=='{}'".format(ch))
     segments = df_tmp[['bgn', 'end']].values // resolution
-    mtx_cor = datasets[exp][ch]
+    mtx_cor = datasets[exp][ch].copy()
     np.fill_diagonal(mtx_cor, 0)
     plt.figure(figsize=[20, 20])
     sns.heatmap(np.log(mtx_cor[begin: end, begin: end] + 1), cmap="Reds", square=True, cbar=False,
@@ -13,6 +13,7 @@ setup(
         'tqdm',
         'jupyter',
         'scipy',
+        'joblib',
         'Cython',
         'cooler',
         'cooltools',